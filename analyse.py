@@ -2,79 +2,1130 @@
 
 Exports:
     - cropRasterDataset for cropping raster data to site boundaries
+    - cropRasterDatasets for cropping rasters to many sites in one go
+    - site_mask_cache, the cache of rasterized sites used by both
+    - readTabularDataset for reading only the rows of a table wf2 needs
     - aggregateTabularDataset for filtering rows of tabular data
+    - aggregateTabularDatasets for filtering tabular data for many sites
+        and zones in one go
+    - summariseTabularDataset for area-weighted totals of tabular data
+    - summariseRasterDataset for summarising raster data per zone
+    - SiteIndex to find which sites a raster or table covers, and
+        readTabularIDs to read just a table's IDs for it
+    - renderCropPreview and renderAggregatePreview to plot the results
+        of the workflows, which are cached in render_cache
+    - invalidateMergeCache to forget wf2 merges cached in merge_cache
+
+The stages of each workflow are measured with span, from
+instrumentation.py if it was loaded first; otherwise span and spanned
+measure nothing.
 """
 
 
+import io
 import os
 import json
+import time
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import rasterio as rio
-import rasterio.mask as riomask
+import rasterio.features as riofeatures
+import rasterio.shutil as rioshutil
+from rasterio.enums import Resampling
+from rasterio.errors import WindowError
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform
+from rasterio.windows import Window, union as windowUnion
 import pandas as pd
 import geopandas as gpd
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-from mpl_toolkits.axes_grid1 import make_axes_locatable
+from shapely.geometry import box
+
+
+# without instrumentation.py, measure nothing
+try:
+    span,spanned
+except NameError:
+    from contextlib import nullcontext
+
+    def span(name,**attributes):
+        return nullcontext()
+
+    def spanned(name):
+        return lambda function: function
+
+
+# largest number of pixels per band to hold in memory at once when streaming
+STREAMING_BLOCK_PIXELS = 1 << 20
+# longest side of the decimated array plotted when streaming
+PREVIEW_SIZE = 1024
+# side of the internal tiles of cloud-optimized GeoTIFFs, which is also
+# the size below which no more overviews are made
+COG_BLOCK_SIZE = 512
+
+
+# helper
+def siteWindow(active_dataset,shapes):
+    """Return the window of a raster covering some shapes, as used by
+    rasterio.mask.mask with crop=True.
+
+    active_dataset: open raster (rasterio.DatasetReader)
+    shapes: geometries in the raster's CRS (GeoSeries)
+    """
+
+    try:
+        window = riofeatures.geometry_window(active_dataset,shapes)
+    except WindowError:
+        raise ValueError('Input shapes do not overlap raster.')
+
+    return Window(int(window.col_off),int(window.row_off),int(window.width),int(window.height))
+
+
+# helper
+def blockWindows(window,block_shape):
+    """Split a window into windows aligned with a raster's internal
+    blocks, merging rows of small (e.g. striped) blocks so that each
+    holds up to STREAMING_BLOCK_PIXELS pixels.
+
+    Splits fall on the raster's own block boundaries, which start at
+    row and column 0, so each block is decoded by one window only, even
+    when the window is narrower than a block or blocks are whole rows.
+
+    window: window to split (Window)
+    block_shape: (rows, columns) of the raster's blocks (tuple)
+    """
+
+    block_rows,block_cols = block_shape
+    block_rows *= max(1,STREAMING_BLOCK_PIXELS // (block_rows*block_cols))
+    row_stop = window.row_off + window.height
+    col_stop = window.col_off + window.width
+
+    row = window.row_off
+    while row < row_stop:
+        next_row = min((row//block_rows + 1)*block_rows,row_stop)
+        col = window.col_off
+        while col < col_stop:
+            next_col = min((col//block_cols + 1)*block_cols,col_stop)
+            yield Window(col,row,next_col-col,next_row-row)
+            col = next_col
+        row = next_row
+
+
+class LRUCache:
+    """Least-recently-used dict with hit and miss counters.
+
+    max_entries: most entries to hold (int)
+    """
+
+    def __init__(self,max_entries=32):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self,key):
+        """Return the value for key, or None if absent."""
+
+        if key in self._items:
+            self.hits += 1
+            self._items.move_to_end(key)
+            return self._items[key]
+        self.misses += 1
+        return None
+
+    def put(self,key,value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+    def invalidate(self,predicate=None):
+        """Drop entries whose keys satisfy predicate(key), or all
+        entries if no predicate is given."""
+
+        for key in [x for x in self._items if predicate is None or predicate(x)]:
+            del self._items[key]
+
+    def stats(self):
+        """Return counters describing the cache as a dict."""
+
+        return {'entries': len(self._items), 'hits': self.hits, 'misses': self.misses}
+
+
+class SiteMaskCache(LRUCache):
+    """Cache of rasterized DEIMS site masks and crop windows, keyed by
+    site and raster grid (CRS, transform, width and height).
+
+    Rasters on a grid seen before, e.g. successive years of the same
+    product, are then cropped without reprojecting or rasterizing the
+    site. Masks are held bit-packed; if cache_dir is set they are also
+    saved there, so they survive restarts and are shared between
+    processes. Keys start with the site ID, so a site whose boundaries
+    change can be dropped with invalidate(lambda x: x[0] == site).
+
+    max_entries: most masks to hold in memory (int)
+    cache_dir: directory in which to persist masks, None to keep them
+      in memory only (str)
+    """
+
+    def __init__(self,max_entries=32,cache_dir=None):
+        super().__init__(max_entries)
+        self.cache_dir = cache_dir
+        self.disk_hits = 0
+
+    def key(self,region,active_dataset):
+        return (region,active_dataset.crs.to_wkt(),tuple(active_dataset.transform)[:6],active_dataset.width,active_dataset.height)
+
+    def path(self,key):
+        return os.path.join(self.cache_dir,hashlib.sha1(repr(key).encode('utf-8')).hexdigest()+'.npz')
+
+    def lookup(self,key):
+        """Return the mask for key from memory or disk, or None."""
+
+        site_mask = self.get(key)
+        if site_mask is None and self.cache_dir is not None:
+            try:
+                with np.load(self.path(key)) as f:
+                    site_mask = {
+                            'window': Window(*[int(x) for x in f['window']]),
+                            'packed': f['packed'],
+                            'preview': f['preview'],
+                            }
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                # truncated or corrupt, e.g. by a crash while writing -
+                # drop it and rasterize again
+                print(f'INFO: discarding unreadable site mask {self.path(key)} ({e})')
+                site_mask = None
+                try:
+                    os.remove(self.path(key))
+                except OSError:
+                    pass
+            else:
+                self.disk_hits += 1
+                self.put(key,site_mask)
+        return site_mask
+
+    def store(self,key,site_mask):
+        self.put(key,site_mask)
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir,exist_ok=True)
+            fd,tmp_path = tempfile.mkstemp(suffix='.npz',dir=self.cache_dir)
+            with os.fdopen(fd,'wb') as f:
+                np.savez_compressed(f,window=np.array(site_mask['window'].flatten()),packed=site_mask['packed'],preview=site_mask['preview'])
+            os.replace(tmp_path,self.path(key))
+
+    def stats(self):
+        return dict(super().stats(),disk_hits=self.disk_hits)
+
+
+# shared by all wf1 runs in this process
+site_mask_cache = SiteMaskCache()
+
+
+# helper
+def fillValue(active_dataset):
+    """Value written outside the site, as in rasterio.mask.mask."""
+
+    return active_dataset.nodata if active_dataset.nodata is not None else 0
+
+
+# helper
+def previewShape(window):
+    """Shape of a window decimated to at most PREVIEW_SIZE per side."""
+
+    scale = max(1,max(window.width,window.height)/PREVIEW_SIZE)
+    return (max(1,round(window.height/scale)),max(1,round(window.width/scale)))
+
+
+# helper
+def rasterizeSiteMask(active_dataset,shapes):
+    """Rasterize some shapes over the window of a raster covering them.
+
+    The mask is built a strip of rows at a time and packed to one bit
+    per pixel, so its memory use stays small for large windows.
+
+    active_dataset: open raster (rasterio.DatasetReader)
+    shapes: geometries in the raster's CRS (GeoSeries)
+
+    Returns a dict of 'window' (Window), 'packed' (rows of the window,
+    bits set outside the shapes) and 'preview' (the same for the window
+    decimated to previewShape).
+    """
+
+    window = siteWindow(active_dataset,shapes)
+    rows = max(1,STREAMING_BLOCK_PIXELS//window.width)
+    strips = []
+    for row in range(0,window.height,rows):
+        strip = Window(window.col_off,window.row_off+row,window.width,min(rows,window.height-row))
+        outside = riofeatures.geometry_mask(shapes,(strip.height,strip.width),active_dataset.window_transform(strip))
+        strips.append(np.packbits(outside,axis=1))
+
+    out_shape = previewShape(window)
+    transform = active_dataset.window_transform(window) * Affine.scale(window.width/out_shape[1],window.height/out_shape[0])
+    preview = riofeatures.geometry_mask(shapes,out_shape,transform)
+
+    return {'window': window, 'packed': np.concatenate(strips), 'preview': np.packbits(preview,axis=1)}
+
+
+# helper
+def unpackMask(packed,row,col,height,width):
+    """Unpack part of a bit-packed mask to a boolean array.
+
+    packed: mask packed along rows (numpy.ndarray)
+    row, col: offset of the part within the mask (int)
+    height, width: size of the part (int)
+    """
+
+    first_byte = col//8
+    bits = np.unpackbits(packed[row:row+height,first_byte:(col+width+7)//8],axis=1)
+    start = col - first_byte*8
+
+    return bits[:,start:start+width].astype(bool)
+
+
+# helper
+def siteMask(active_dataset,region,reprojected=None):
+    """Return the mask of a DEIMS site over a raster (as returned by
+    rasterizeSiteMask), using site_mask_cache where possible.
+
+    active_dataset: open raster (rasterio.DatasetReader)
+    region: DEIMS site ID (str)
+    reprojected: memo of site boundaries already reprojected, keyed by
+      (site, CRS), to reuse across rasters of different grids (dict)
+
+    Requires a dictionary validated_deims_sites to be available as a
+    free variable - see cropRasterDataset.
+    """
+
+    key = site_mask_cache.key(region,active_dataset)
+    site_mask = site_mask_cache.lookup(key)
+    if site_mask is None:
+        memo_key = (region,active_dataset.crs.to_string())
+        if reprojected is not None and memo_key in reprojected:
+            shapes = reprojected[memo_key]
+        else:
+            # coerce site to dataset CRS
+            with span('wf1/load-site',site=region):
+                site_boundary = validated_deims_sites[region]['boundaries']
+            if site_boundary.crs != active_dataset.crs:
+                with span('wf1/reproject',site=region):
+                    site_boundary = site_boundary.to_crs(active_dataset.crs)
+            shapes = site_boundary.geometry
+            if reprojected is not None:
+                reprojected[memo_key] = shapes
+        with span('wf1/rasterize',site=region):
+            site_mask = rasterizeSiteMask(active_dataset,shapes)
+        site_mask_cache.store(key,site_mask)
+
+    return site_mask
+
+
+# helper
+def warpedGrid(active_dataset,region,dst_crs,resolution=None):
+    """Return a grid in another CRS covering a DEIMS site, aligned to
+    multiples of its resolution.
+
+    active_dataset: open raster (rasterio.DatasetReader)
+    region: DEIMS site ID (str)
+    dst_crs: CRS of the grid, e.g. 'EPSG:3035' (str)
+    resolution: pixel size in units of dst_crs, as one number or
+      (x, y), None for about the raster's own over the site (float/tuple)
+
+    Requires a dictionary validated_deims_sites to be available as a
+    free variable - see cropRasterDataset.
+
+    Returns (transform, width, height).
+    """
+
+    site_boundary = validated_deims_sites[region]['boundaries']
+    if resolution is None:
+        source_shapes = site_boundary.to_crs(active_dataset.crs) if site_boundary.crs != active_dataset.crs else site_boundary
+        window = siteWindow(active_dataset,source_shapes.geometry)
+        transform,width,height = calculate_default_transform(active_dataset.crs,dst_crs,window.width,window.height,*active_dataset.window_bounds(window))
+        resolution = (transform.a,-transform.e)
+    elif np.isscalar(resolution):
+        resolution = (resolution,resolution)
+
+    xres,yres = resolution
+    left,bottom,right,top = site_boundary.to_crs(dst_crs).total_bounds
+    left = np.floor(left/xres)*xres
+    top = np.ceil(top/yres)*yres
+    width = max(1,int(np.ceil((right-left)/xres)))
+    height = max(1,int(np.ceil((top-bottom)/yres)))
+
+    return (Affine(xres,0,left,0,-yres,top),width,height)
+
+
+# helper
+def warpedView(active_dataset,region,dst_crs,resolution=None,resampling='nearest'):
+    """Return a lazily reprojected view of a raster over a DEIMS site:
+    only source pixels under the site's grid (see warpedGrid) are read
+    and resampled, as the view itself is read.
+
+    Arguments as for warpedGrid, plus:
+    resampling: name of a rasterio.enums.Resampling method, e.g.
+      'nearest', 'bilinear' or 'average' (str)
+
+    Returns rasterio.vrt.WarpedVRT, to use in place of the raster.
+    """
+
+    if resampling not in Resampling.__members__:
+        raise ValueError(f'Unknown resampling {resampling}, expected one of {list(Resampling.__members__)}')
+    transform,width,height = warpedGrid(active_dataset,region,dst_crs,resolution)
+
+    return WarpedVRT(active_dataset,crs=dst_crs,transform=transform,width=width,height=height,resampling=Resampling[resampling])
+
+
+# helper
+def readPreview(active_dataset,site_mask):
+    """Read a decimated copy of the first band of a site's window,
+    masked outside the site.
+
+    active_dataset: open raster (rasterio.DatasetReader)
+    site_mask: mask of the site, see siteMask (dict)
+    """
+
+    window = site_mask['window']
+    out_shape = previewShape(window)
+    preview = active_dataset.read(1,window=window,out_shape=out_shape)
+    outside = unpackMask(site_mask['preview'],0,0,out_shape[0],out_shape[1])
+
+    return np.ma.masked_array(preview,mask=outside)
+
+
+# helper
+def streamCropGroup(active_dataset,targets):
+    """Crop a raster to several sites in one pass, one block at a time,
+    so that blocks shared by overlapping sites are read once.
+
+    active_dataset: open raster (rasterio.DatasetReader)
+    targets: (site_mask, dest) for each crop, where site_mask comes from
+      siteMask and dest is an open output raster of the size of its
+      window (list(tuple))
+    """
+
+    nodata = fillValue(active_dataset)
+    group_window = windowUnion(*[x[0]['window'] for x in targets])
+
+    for block in blockWindows(group_window,active_dataset.block_shapes[0]):
+        data = None
+        for site_mask,dest in targets:
+            window = site_mask['window']
+            try:
+                overlap = block.intersection(window)
+            except WindowError:
+                continue
+            if overlap.width == 0 or overlap.height == 0:
+                continue
+            # only read blocks some site needs
+            if data is None:
+                data = active_dataset.read(window=block)
+            row = overlap.row_off - block.row_off
+            col = overlap.col_off - block.col_off
+            part = data[:,row:row+overlap.height,col:col+overlap.width].copy()
+            outside = unpackMask(site_mask['packed'],overlap.row_off-window.row_off,overlap.col_off-window.col_off,overlap.height,overlap.width)
+            part[:,outside] = nodata
+            dest.write(part,window=Window(overlap.col_off-window.col_off,overlap.row_off-window.row_off,overlap.width,overlap.height))
+
+
+# helper
+def croppedMeta(active_dataset,window):
+    """Return the metadata for a GeoTIFF of a window of a raster."""
+
+    out_meta = active_dataset.meta.copy()
+    out_meta.update({
+        'driver': 'GTiff',
+        'height': window.height,
+        'width': window.width,
+        'transform': active_dataset.window_transform(window)
+        })
+
+    return out_meta
+
+
+# helper
+def tiledMeta(out_meta,compress='deflate'):
+    """Return metadata from croppedMeta with the creation options of a
+    tiled, compressed GeoTIFF.
+
+    out_meta: metadata to add to (dict)
+    compress: 'deflate', 'lzw', 'zstd' or None for no compression (str)
+    """
+
+    if compress is not None and compress.lower() not in ('deflate','lzw','zstd'):
+        raise ValueError(f'Unsupported compression: {compress}')
+
+    tiled_meta = dict(out_meta,tiled=True,blockxsize=COG_BLOCK_SIZE,blockysize=COG_BLOCK_SIZE,BIGTIFF='IF_SAFER')
+    tiled_meta.pop('compress',None)
+    tiled_meta.pop('predictor',None)
+    if compress is not None:
+        tiled_meta['compress'] = compress.lower()
+        # floating point prediction for floats, differencing for integers
+        tiled_meta['predictor'] = 3 if np.dtype(out_meta['dtype']).kind == 'f' else 2
+
+    return tiled_meta
+
+
+# helper
+def overviewFactors(width,height):
+    """Return decimation factors of overviews of a raster, halving until
+    the smallest fits in a tile of COG_BLOCK_SIZE."""
+
+    factors = []
+    while max(width,height)/2**len(factors) > COG_BLOCK_SIZE:
+        factors.append(2**(len(factors)+1))
+
+    return factors
+
+
+# helper
+def finishCOG(tiled_path,cog_path,tiled_meta):
+    """Build overviews of a tiled GeoTIFF and copy it, with them, to a
+    cloud-optimized layout, i.e. with overviews ahead of the full
+    resolution tiles.
+
+    tiled_path: GeoTIFF written with tiledMeta, which is modified (str)
+    cog_path: where to write the cloud-optimized GeoTIFF (str)
+    tiled_meta: metadata tiled_path was written with (dict)
+    """
+
+    with rio.open(tiled_path,'r+') as tiled:
+        factors = overviewFactors(tiled.width,tiled.height)
+        if factors:
+            tiled.build_overviews(factors,Resampling.nearest)
+
+    options = {x: tiled_meta[x] for x in ['tiled','blockxsize','blockysize','compress','predictor','BIGTIFF'] if x in tiled_meta}
+    rioshutil.copy(tiled_path,cog_path,driver='GTiff',copy_src_overviews=True,**options)
+
+
+# helper
+def groupOverlappingWindows(windows):
+    """Group windows into connected sets of overlapping windows.
+
+    windows: windows to group, keyed by anything (dict)
+
+    Returns list(list) of keys.
+    """
+
+    keys = list(windows)
+    parents = {x: x for x in keys}
+
+    def root(x):
+        while parents[x] != x:
+            parents[x] = parents[parents[x]]
+            x = parents[x]
+        return x
+
+    for i,x in enumerate(keys):
+        for y in keys[i+1:]:
+            a,b = windows[x],windows[y]
+            if a.col_off < b.col_off+b.width and b.col_off < a.col_off+a.width and a.row_off < b.row_off+b.height and b.row_off < a.row_off+a.height:
+                parents[root(x)] = root(y)
+
+    groups = {}
+    for x in keys:
+        groups.setdefault(root(x),[]).append(x)
+
+    return list(groups.values())
+
+
+# helper
+def batchDatasetNames(datasets):
+    """Name the outputs of each dataset of a batch by its filename up to
+    the first dot, adding a hash of its path where datasets from
+    different directories share a name, so that none overwrite another.
+
+    datasets: filepaths to raster datasets, without repeats (list(str))
+
+    Returns a dict of names by filepath.
+    """
+
+    stems = {x: os.path.basename(x).split('.')[0] for x in datasets}
+    counts = pd.Series(list(stems.values()),dtype=object).value_counts()
+
+    return {
+            x: stem if counts[stem] == 1 else f'{stem}-{hashlib.sha1(os.path.abspath(x).encode("utf-8")).hexdigest()[:8]}'
+            for x,stem in stems.items()
+            }
+
+
+# helper
+def cropRasterGroup(job):
+    """Run one job planned by cropRasterDatasets in a worker process.
+
+    job: dict of 'dataset' and 'targets', a list of (site, site mask,
+      output path) tuples, and optionally 'cog' and 'compress' as for
+      cropRasterDataset
+
+    Returns the job with its wall time in seconds added.
+    """
+
+    start = time.perf_counter()
+    paths = [x[2] for x in job['targets']]
+    if job.get('cog'):
+        # tiles are written beside each output, then laid out with overviews
+        paths = [os.path.join(os.path.dirname(x),'.tiled-'+os.path.basename(x)) for x in paths]
+    try:
+        with rio.open(job['dataset']) as active_dataset:
+            metas = [croppedMeta(active_dataset,x[1]['window']) for x in job['targets']]
+            if job.get('cog'):
+                metas = [tiledMeta(x,job['compress']) for x in metas]
+            dests = []
+            try:
+                for path,meta in zip(paths,metas):
+                    dests.append(rio.open(path,'w',**meta))
+                streamCropGroup(active_dataset,[(x[1],dest) for x,dest in zip(job['targets'],dests)])
+            finally:
+                for dest in dests:
+                    dest.close()
+
+        if job.get('cog'):
+            for x,path,meta in zip(job['targets'],paths,metas):
+                finishCOG(path,x[2],meta)
+    finally:
+        if job.get('cog'):
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    return dict(job,seconds=time.perf_counter()-start)
+
+
+# rendered PNGs, keyed by a hash of everything they depend on
+render_cache = LRUCache(64)
+
+
+# helper
+def fingerprintDataFrame(dataset):
+    """Return a hash of a DataFrame's column names, types and values.
+
+    dataset: table to fingerprint (pandas.DataFrame)
+    """
+
+    digest = hashlib.sha1(repr([(str(x),str(y)) for x,y in dataset.dtypes.items()]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(dataset,index=False).values.tobytes())
+
+    return digest.hexdigest()
+
+
+# helper
+def fingerprintFile(path):
+    """Return a cheap identifier for the contents of a file."""
+
+    stat = os.stat(path)
+    return (os.path.abspath(path),stat.st_size,stat.st_mtime_ns)
+
+
+# helper
+def renderCached(key,draw,out_path):
+    """Render a figure unless an identical one is in render_cache.
+
+    key: everything the figure depends on (tuple)
+    draw: called as draw(fig, ax) to populate the figure (function)
+    out_path: where to write the PNG, or None (str)
+
+    Returns the PNG (bytes).
+    """
+
+    key = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    png = render_cache.get(key)
+    if png is None:
+        # only the rendering stage needs matplotlib
+        import matplotlib.pyplot as plt
+
+        fig, ax = plt.subplots()
+        try:
+            with span('render/draw'):
+                draw(fig,ax)
+            buffer = io.BytesIO()
+            with span('render/savefig'):
+                fig.savefig(buffer,format='png')
+        finally:
+            # close plot to save memory
+            plt.close(fig)
+        png = buffer.getvalue()
+        render_cache.put(key,png)
+
+    if out_path is not None:
+        with open(out_path,'wb') as f:
+            f.write(png)
+
+    return png
+
+
+def renderCropPreview(dataset,region,dataset_title,out_path='/tmp/crop.png',preview=None,warp=None):
+    """Plot the first band of a raster dataset cropped to a site.
+
+    dataset: filepath to the raster dataset (str)
+    region: DEIMS site ID (str)
+    dataset_title: name of data to use in plot title (str)
+    out_path: where to write the PNG, or None (str)
+    preview: array to plot, read decimated from dataset if not given
+      (numpy.ndarray)
+    warp: arguments of warpedView the preview was read with, if any,
+      which must then be given (dict)
+
+    Requires a dictionary validated_deims_sites to be available as a
+    free variable - see cropRasterDataset.
+
+    Returns the PNG (bytes).
+    """
+
+    site_name = validated_deims_sites[region]['metadata']['displayName']
+
+    def draw(fig,ax):
+        import matplotlib.colors as colors
+
+        image = preview
+        if image is None:
+            with rio.open(dataset) as active_dataset:
+                image = readPreview(active_dataset,siteMask(active_dataset,region))
+        ax.set_axis_off()
+        ax.set_title(f'{dataset_title} data cropped to {site_name}')
+        ax.imshow(image,norm=colors.LogNorm(vmin=1e-2, vmax=200))
+
+    key = ('crop',fingerprintFile(dataset),region,dataset_title)
+    if warp is not None:
+        key += (tuple(sorted(warp.items())),)
+    return renderCached(key,draw,out_path)
+
+
+def renderAggregatePreview(dataset,deims_site,admin_zones,plot_key,plot_title,out_path='/tmp/plot.png',merged_dataset=None,fingerprint=None):
+    """Plot a table filtered to a DEIMS site as a chloropleth map.
+
+    Arguments as for aggregateTabularDataset, plus:
+    out_path: where to write the PNG, or None (str)
+    merged_dataset: the composite merged with dataset, merged here if
+      not given (geopandas.GeoDataFrame)
+    fingerprint: fingerprintDataFrame of dataset, if already known (str)
+
+    Returns the PNG (bytes).
+    """
+
+    site_name = validated_deims_sites[deims_site]['metadata']['displayName']
+    admin_zones_name = validated_zones[admin_zones]['metadata']['displayName']
+
+    def draw(fig,ax):
+        from mpl_toolkits.axes_grid1 import make_axes_locatable
+
+        merged = merged_dataset
+        if merged is None:
+            merged = mergeComposite(dataset,deims_site,admin_zones,fingerprint)
+        # from geopandas docs: align legend to plot
+        divider = make_axes_locatable(ax)
+        cax = divider.append_axes('right', size='5%', pad=0.1)
+        # additional formatting
+        ax.set_axis_off()
+        ax.set_title(f'{plot_title} data cropped to {site_name} by {admin_zones_name}')
+        merged.plot(ax=ax,column=plot_key,legend=True,cax=cax,missing_kwds={'color':'lightgrey'})
+
+    if fingerprint is None:
+        fingerprint = fingerprintDataFrame(dataset)
+
+    return renderCached(('aggregate',fingerprint,deims_site,admin_zones,plot_key,plot_title),draw,out_path)
+
+
+# helper
+def newSessionDirectory():
+    """Create a private temporary directory for one session's or one
+    request's workflow outputs, to pass as a workflow's output."""
+
+    return tempfile.mkdtemp(prefix='sdp-')
+
+
+# helper
+def outputPath(output,filename):
+    """Resolve where a workflow should write one of its outputs.
+
+    output: None for the shared /tmp directory, 'memory' to keep the
+      output in memory, or a directory, created if needed (str)
+    filename: name of the output file (str)
+
+    Returns a file path, or None for in-memory output.
+    """
+
+    if output is None:
+        return f'/tmp/{filename}'
+    if output == 'memory':
+        return None
+    os.makedirs(output,exist_ok=True)
+
+    return os.path.join(output,filename)
 
 
 # WORKFLOW DEFINITIONS
-def cropRasterDataset(dataset,region,dataset_title):
+@spanned('wf1')
+def cropRasterDataset(dataset,region,dataset_title,streaming=False,render=True,output=None,cog=False,compress='deflate',dst_crs=None,resolution=None,resampling='nearest'):
     """wf1 - extract a subset of a raster dataset.
 
     dataset: filepath to a raster dataset to open and crop (str)
     region: region to extract from dataset (GeoDataFrame)
     dataset_title: name of data to use in plot title (str)
+    streaming: crop block by block and plot a decimated preview, so
+      that memory use is bounded by block size rather than by the size
+      of the crop - use for rasters larger than memory (bool)
+    render: whether to plot the output, otherwise matplotlib is not
+      used - see renderCropPreview (bool)
+    output: where to put the outputs - None for /tmp, shared by every
+      caller, 'memory' to return them as bytes, or a directory such as
+      one from newSessionDirectory (str)
+    cog: write a cloud-optimized GeoTIFF - tiled, compressed and with
+      overviews - rather than copying the layout of dataset; the crop
+      is then always streamed, as it is written to a scratch file
+      anyway (bool)
+    compress: compression of a cloud-optimized GeoTIFF, 'deflate',
+      'lzw', 'zstd' or None (str)
+    dst_crs: deliver the crop in this CRS rather than the dataset's,
+      reading it through a warped view (see warpedView) so that only
+      pixels under the site are read and resampled (str)
+    resolution: pixel size of the crop in units of dst_crs, as one
+      number or (x, y), None for about the dataset's own (float/tuple)
+    resampling: resampling method when dst_crs is given, see
+      warpedView (str)
 
     Requires a dictionary validated_deims_sites to be available as a
     free variable.  It should contain data about available DEIMS sites
     in a certain format - see directoryparse.loadAllInfo.
 
-    Writes output to /tmp/masked.tif and /tmp/crop.png, returns 0.
+    Writes output to masked.tif and crop.png. If output is None these
+    are in /tmp and 0 is returned, otherwise returns a dict of 'raster'
+    and 'plot' (None if not rendered), each either a path or bytes.
     """
 
     # setup
     # load user data
-    active_dataset = rio.open(dataset)
-
-    # get site boundary and name from user input
-    site_boundary = validated_deims_sites[region]['boundaries']
-    site_name = validated_deims_sites[region]['metadata']['displayName']
+    with span('wf1/open'):
+        source_dataset = rio.open(dataset)
+    active_dataset = source_dataset
+    memfile = None
+    scratch_dir = None
+    # close everything opened here even if the crop fails, as workers
+    # (see jobservice.py) would otherwise accumulate open rasters
+    try:
+        warp = None
+        if dst_crs is not None:
+            # read through a reprojecting view of the site's area instead
+            warp = {'dst_crs': str(dst_crs), 'resolution': resolution, 'resampling': resampling}
+            with span('wf1/warp',crs=warp['dst_crs']):
+                active_dataset = warpedView(source_dataset,region,dst_crs,resolution,resampling)
+        raster_path = outputPath(output,'masked.tif')
+        plot_path = outputPath(output,'crop.png')
 
-    # coerce site to dataset CRS
-    if site_boundary.crs != active_dataset.crs:
-        site_boundary = site_boundary.to_crs(active_dataset.crs)
+        # get site mask from user input, reprojecting and rasterizing the
+        # site boundary unless cached for this grid
+        site_mask = siteMask(active_dataset,region)
+        window = site_mask['window']
 
-    # figures
-    fig, ax = plt.subplots()
-    ax.set_axis_off()
+        # here we go
+        preview = None
+        out_meta = croppedMeta(active_dataset,window)
+        if cog:
+            # write tiles to a scratch file, then lay them out along with
+            # overviews in the output
+            tiled_meta = tiledMeta(out_meta,compress)
+            scratch_dir = tempfile.mkdtemp()
+            tiled_path = os.path.join(scratch_dir,'tiled.tif')
+            dest = rio.open(tiled_path,'w',**tiled_meta)
+        elif raster_path is None:
+            memfile = MemoryFile()
+            dest = memfile.open(**out_meta)
+        else:
+            dest = rio.open(raster_path,'w',**out_meta)
+        with dest:
+            if streaming or cog:
+                # intersect site and dataset, writing cropped data as we go
+                with span('wf1/crop',streaming=True):
+                    streamCropGroup(active_dataset,[(site_mask,dest)])
+                if warp is not None and render:
+                    # renderCropPreview would read the unwarped dataset
+                    preview = readPreview(active_dataset,site_mask)
+            else:
+                # intersect site and dataset
+                with span('wf1/crop',streaming=False):
+                    out_image = active_dataset.read(window=window)
+                    out_image[:,unpackMask(site_mask['packed'],0,0,window.height,window.width)] = fillValue(active_dataset)
 
-    # here we go
-    # intersect site and dataset
-    out_image, out_transform = riomask.mask(active_dataset, site_boundary.geometry, crop=True)
-    out_meta = active_dataset.meta
-    out_meta.update({
-        'driver': 'GTiff',
-        'height': out_image.shape[1],
-        'width': out_image.shape[2],
-        'transform': out_transform
-        })
+                # write cropped data
+                with span('wf1/write'):
+                    dest.write(out_image)
+                preview = out_image[0]
 
-    # write cropped data to disk
-    with rio.open('/tmp/masked.tif', 'w', **out_meta) as dest:
-        dest.write(out_image)
-        dest.close()
+        raster = raster_path
+        if memfile is not None:
+            memfile.seek(0)
+            raster = memfile.read()
+        if scratch_dir is not None:
+            cog_path = raster_path if raster_path is not None else os.path.join(scratch_dir,'masked.tif')
+            with span('wf1/cog'):
+                finishCOG(tiled_path,cog_path,tiled_meta)
+            if raster_path is None:
+                with open(cog_path,'rb') as f:
+                    raster = f.read()
+    finally:
+        if active_dataset is not source_dataset:
+            active_dataset.close()
+        source_dataset.close()
+        if memfile is not None:
+            memfile.close()
+        if scratch_dir is not None:
+            shutil.rmtree(scratch_dir,ignore_errors=True)
 
     # populate and save graph
-    ax.set_title(f'{dataset_title} data cropped to {site_name}')
-    ax.imshow(out_image[0],norm=colors.LogNorm(vmin=1e-2, vmax=200))
-    fig.savefig('/tmp/crop.png')
-    plt.close(fig)
+    plot = None
+    if render:
+        with span('wf1/render'):
+            plot = renderCropPreview(dataset,region,dataset_title,plot_path,preview,warp)
+        if plot_path is not None:
+            plot = plot_path
+
+    if output is None:
+        return 0
+    return {'raster': raster, 'plot': plot}
+
+
+@spanned('wf1-batch')
+def cropRasterDatasets(datasets,regions,output_dir,processes=None,cog=False,compress='deflate'):
+    """Batch wf1 - crop one or more raster datasets to many DEIMS sites.
+
+    Each site's boundaries are reprojected once per raster CRS and
+    rasterized once per raster grid (see SiteMaskCache). Sites
+    whose windows of a raster overlap are cropped together in one
+    streamed pass, so shared blocks are read once, and these
+    independent (raster, group of sites) jobs are spread over a pool of
+    processes.
+
+    datasets: filepaths to raster datasets to crop (list(str))
+    regions: IDs of DEIMS sites to crop to, or None for all sites
+      (list(str))
+    output_dir: directory in which to write '<dataset>-<site>.tif',
+      where <dataset> is the dataset's filename up to its first dot,
+      followed by a hash of its path if another dataset shares it
+    processes: number of worker processes, None for one per CPU or 1 to
+      work in this process (int)
+    cog, compress: write cloud-optimized GeoTIFFs, as for
+      cropRasterDataset
+
+    Requires a dictionary validated_deims_sites to be available as a
+    free variable - see cropRasterDataset.
+
+    Returns a manifest with one dict per (dataset, site) of 'dataset',
+    'site', 'path' (None if the site does not overlap the dataset),
+    'job' (index of the job which wrote it) and 'seconds' (wall time of
+    that job).
+    """
+
+    if isinstance(datasets,str):
+        datasets = [datasets]
+    datasets = list(dict.fromkeys(datasets))
+    dataset_names = batchDatasetNames(datasets)
+    if regions is None:
+        regions = list(validated_deims_sites)
+    os.makedirs(output_dir,exist_ok=True)
 
-    return 0
+    # plan jobs, reprojecting each site at most once per CRS
+    jobs = []
+    manifest = []
+    reprojected = {}
+    for dataset in datasets:
+        dataset_name = dataset_names[dataset]
+        site_masks = {}
+        with rio.open(dataset) as active_dataset:
+            for region in regions:
+                try:
+                    site_masks[region] = siteMask(active_dataset,region,reprojected)
+                except ValueError:
+                    manifest.append({'dataset': dataset, 'site': region, 'path': None, 'job': None, 'seconds': None})
 
+        for group in groupOverlappingWindows({x: site_masks[x]['window'] for x in site_masks}):
+            jobs.append({
+                'dataset': dataset,
+                'targets': [(x,site_masks[x],os.path.join(output_dir,f'{dataset_name}-{x}.tif')) for x in group],
+                'cog': cog,
+                'compress': compress,
+                })
 
-def aggregateTabularDataset(dataset,deims_site,admin_zones,plot_key,plot_title):
+    # run jobs
+    with span('wf1-batch/run',jobs=len(jobs)):
+        if processes == 1:
+            results = [cropRasterGroup(x) for x in jobs]
+        else:
+            # forked workers inherit everything loaded so far
+            with ProcessPoolExecutor(processes,mp_context=multiprocessing.get_context('fork')) as pool:
+                results = list(pool.map(cropRasterGroup,jobs))
+
+    for i,result in enumerate(results):
+        for target in result['targets']:
+            manifest.append({
+                'dataset': result['dataset'],
+                'site': target[0],
+                'path': target[2],
+                'job': i,
+                'seconds': result['seconds'],
+                })
+
+    return manifest
+
+
+# rows read from a CSV at once when ingesting tables for wf2
+TABULAR_CHUNK_ROWS = 100000
+
+
+# helper
+def tabularID(value):
+    """ID of a zone as the string stored in composites - spreadsheets
+    give whole numbers as floats."""
+    if isinstance(value,float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# helper
+@spanned('wf2/read')
+def readTabularDataset(path,deims_site,admin_zones,columns=None,sheet=None,chunksize=TABULAR_CHUNK_ROWS):
+    """Read the rows of a table needed by wf2 for a site and zones.
+
+    The file is streamed rather than loaded whole, keeping only rows
+    whose first column is one of the composite's zone IDs, and only the
+    ID column plus the requested columns, so memory scales with the site
+    rather than the file.
+    - CSV is read chunksize rows at a time
+    - Parquet is filtered by pyarrow while scanning
+    - XLSX is read row by row with openpyxl; older XLS files, which
+        openpyxl can't read, are loaded whole and then filtered
+
+    path: path to the CSV, Parquet or Excel file (str)
+    deims_site: DEIMS site ID (str)
+    admin_zones: zone code (str)
+    columns: columns to load besides the first, None for all (list(str))
+    sheet: sheet of an Excel file, None for the first (str)
+    chunksize: rows per chunk when reading CSV (int)
+
+    Requires a dictionary validated_deims_sites to be available as a
+    free variable - see aggregateTabularDataset.
+
+    Returns pandas.DataFrame with the ID as its first column, read as
+    strings.
+    """
+
+    composite = compositeAttributes(validated_deims_sites[deims_site],admin_zones)
+    zone_ids = set(composite['zone_id'].map(tabularID))
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension=='.csv':
+        header = list(pd.read_csv(path,nrows=0).columns)
+        keep = header if columns is None else [header[0]]+[x for x in columns if x!=header[0]]
+        chunks = pd.read_csv(path,usecols=keep,dtype={header[0]:str},chunksize=chunksize)
+        dataset = pd.concat([chunk[chunk[header[0]].isin(zone_ids)] for chunk in chunks],ignore_index=True)
+        return dataset[keep]
+
+    if extension=='.parquet':
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.dataset as pads
+        source = pads.dataset(path,format='parquet')
+        id_field = source.schema.field(0)
+        keep = source.schema.names if columns is None else [id_field.name]+[x for x in columns if x!=id_field.name]
+        try:
+            wanted = pa.array(sorted(zone_ids)).cast(id_field.type)
+        except (pa.ArrowInvalid,pa.ArrowNotImplementedError):
+            # IDs can't all be represented, so compare as strings
+            table = source.to_table(columns=keep)
+            table = table.filter(pc.is_in(pc.cast(table[id_field.name],pa.string()),value_set=pa.array(sorted(zone_ids))))
+        else:
+            table = source.to_table(columns=keep,filter=pads.field(id_field.name).isin(wanted))
+        dataset = table.to_pandas()
+        dataset[id_field.name] = dataset[id_field.name].map(tabularID)
+        return dataset
+
+    if extension in ('.xlsx','.xlsm'):
+        import openpyxl
+        workbook = openpyxl.load_workbook(path,read_only=True,data_only=True)
+        try:
+            worksheet = workbook.active if sheet is None else workbook[sheet]
+            rows = worksheet.iter_rows(values_only=True)
+            header = list(next(rows))
+            keep = header if columns is None else [header[0]]+[x for x in columns if x!=header[0]]
+            indices = [header.index(x) for x in keep]
+            kept = [[row[i] for i in indices] for row in rows if row[0] is not None and tabularID(row[0]) in zone_ids]
+        finally:
+            workbook.close()
+        dataset = pd.DataFrame(kept,columns=keep)
+        dataset[keep[0]] = dataset[keep[0]].map(tabularID)
+        return dataset
+
+    if extension=='.xls':
+        dataset = pd.read_excel(path,sheet_name=0 if sheet is None else sheet)
+        keep = list(dataset.columns) if columns is None else [dataset.columns[0]]+[x for x in columns if x!=dataset.columns[0]]
+        dataset = dataset[keep]
+        dataset[keep[0]] = dataset[keep[0]].map(tabularID)
+        return dataset[dataset[keep[0]].isin(zone_ids)].reset_index(drop=True)
+
+    raise ValueError('Unsupported table format: '+path)
+
+
+# merged composites and tables, keyed by (fingerprintDataFrame of the
+# table, site, zones), so that re-plotting the same data with another
+# column or title doesn't redo the merge
+merge_cache = LRUCache(8)
+
+
+def invalidateMergeCache(deims_site=None,admin_zones=None):
+    """Forget merged tables for a site and/or zones, e.g. after their
+    composite changes, or all of them if neither is given.
+
+    deims_site: DEIMS site ID (str)
+    admin_zones: zone code (str)
+    """
+
+    merge_cache.invalidate(lambda x: (deims_site is None or x[1] == deims_site) and (admin_zones is None or x[2] == admin_zones))
+
+
+# helper
+def mergeComposite(dataset,deims_site,admin_zones,fingerprint=None):
+    """Left join a table onto a site's composite by zone ID, reusing
+    the result from merge_cache if the same table was merged before.
+
+    Only the coarse tier of the composite's geometry is loaded (see
+    directoryparse.geometryTier): the geometry is only plotted, and
+    wf2 returns the merged table without it.
+
+    Arguments as for aggregateTabularDataset, plus:
+    fingerprint: fingerprintDataFrame of dataset, if already known (str)
+
+    Returns geopandas.GeoDataFrame, which is shared with the cache and
+    must not be modified.
+    """
+
+    if fingerprint is None:
+        fingerprint = fingerprintDataFrame(dataset)
+    key = (fingerprint,deims_site,admin_zones)
+    merged_dataset = merge_cache.get(key)
+    if merged_dataset is None:
+        # select composite deims/zones shapefile data
+        with span('wf2/load-composite',site=deims_site,zones=admin_zones):
+            composite_site = geometryTier(validated_deims_sites[deims_site],'coarse',admin_zones)
+
+        # take name of first column of dataset - will pass to merge function assuming it contains IDs
+        right_on_key = dataset.columns[0]
+
+        with span('wf2/merge',rows=len(dataset)):
+            merged_dataset = pd.merge(composite_site,dataset,how='left',left_on='zone_id',right_on=right_on_key)
+        merge_cache.put(key,merged_dataset)
+
+    return merged_dataset
+
+
+@spanned('wf2')
+def aggregateTabularDataset(dataset,deims_site,admin_zones,plot_key,plot_title,render=True,output=None):
     """wf2 - extract rows from a table relating to a DEIMS site.
 
     dataset: tabular dataset to filter (pandas.DataFrame)
@@ -82,43 +1133,517 @@ def aggregateTabularDataset(dataset,deims_site,admin_zones,plot_key,plot_title):
     admin_zones: divided by these boundaries (str)
     plot_key: dataset column to plot (str)
     plot_title: name of data to use in plot title (str)
+    render: whether to plot the output, otherwise matplotlib is not
+      used - see renderAggregatePreview (bool)
+    output: where to write the plot - None for /tmp, shared by every
+      caller, 'memory' to write nothing, or a directory such as one
+      from newSessionDirectory (str). With 'memory', calling
+      renderAggregatePreview with the same arguments returns the plot
+      as bytes from render_cache without re-rendering.
 
     Requires two dictionaries to be available as free variables,
     validated_deims_sites and validated_zones. These should contain
     data about available DEIMS sites and administrative zones in a
     certain format - see directoryparse.loadAllInfo.
 
-    Writes plot to /tmp/plot.png and returns pandas.DataFrame.
+    Writes plot to plot.png in /tmp or output and returns
+    pandas.DataFrame.
     """
 
-    # select composite deims/zones shapefile data and metadata
-    composite_site = validated_deims_sites[deims_site]['composites'][admin_zones]
-    site_name = validated_deims_sites[deims_site]['metadata']['displayName']
-    admin_zones_name = validated_zones[admin_zones]['metadata']['displayName']
-
-    # take name of first column of dataset - will pass to merge function assuming it contains IDs
+    # take name of first column of dataset, assumed to contain IDs
     right_on_key = dataset.columns[0]
 
-    # figures
-    fig, ax = plt.subplots()
-
     # here we go
-    # merge
-    merged_dataset = pd.merge(composite_site,dataset,how='left',left_on='zone_id',right_on=right_on_key)
-
-    # plot output
-    # from geopandas docs: align legend to plot
-    divider = make_axes_locatable(ax)
-    cax = divider.append_axes('right', size='5%', pad=0.1)
-    # additional formatting
-    ax.set_axis_off()
-    ax.set_title(f'{plot_title} data cropped to {site_name} by {admin_zones_name}')
-    # plot output, save to temporary image and close plot to save memory
-    merged_dataset.plot(ax=ax,column=plot_key,legend=True,cax=cax,missing_kwds={'color':'lightgrey'})
-    fig.savefig('/tmp/plot.png')
-    plt.close(fig)
+    # merge, or reuse the merge of an identical table
+    with span('wf2/fingerprint'):
+        fingerprint = fingerprintDataFrame(dataset)
+    merged_dataset = mergeComposite(dataset,deims_site,admin_zones,fingerprint)
+
+    # plot output and save to temporary image
+    if render:
+        with span('wf2/render'):
+            renderAggregatePreview(dataset,deims_site,admin_zones,plot_key,plot_title,outputPath(output,'plot.png'),merged_dataset,fingerprint)
 
     if right_on_key != 'zone_id':
         return merged_dataset.drop(columns=[right_on_key,'geometry'])
     else:
         return merged_dataset.drop(columns='geometry')
+
+
+# helper
+def buildCompositeLookup(deims_sites=None,admin_zones=None,with_area=False):
+    """Concatenate the composites of several sites and zones into one
+    table, without geometry, tagged with the site and zones of each row.
+
+    deims_sites: DEIMS site IDs, None for all sites (list(str))
+    admin_zones: zone codes, None for every zone available to each site
+      - combinations a site has no composite for are skipped (list(str))
+    with_area: add 'intersection_area', the area of each clipped zone in
+      units of its composite's CRS (bool)
+
+    Requires a dictionary validated_deims_sites to be available as a
+    free variable - see aggregateTabularDataset.
+
+    Returns pandas.DataFrame indexed by zone ID, with columns
+    'deims_site', 'admin_zones', 'zone_name' and 'area_ratio'.
+    """
+
+    if deims_sites is None:
+        deims_sites = list(validated_deims_sites)
+
+    frames = []
+    for site in deims_sites:
+        composites = validated_deims_sites[site]['composites']
+        for zones in (list(composites) if admin_zones is None else admin_zones):
+            if zones not in composites:
+                continue
+            try:
+                if with_area:
+                    composite = composites[zones]
+                    frame = pd.DataFrame(composite.drop(columns=composite.geometry.name))
+                    frame['intersection_area'] = composite.geometry.area.values
+                else:
+                    frame = compositeAttributes(validated_deims_sites[site],zones)
+            except KeyError:
+                # the composite could not be read, see LazyComposites
+                continue
+            frame.insert(0,'admin_zones',zones)
+            frame.insert(0,'deims_site',site)
+            frames.append(frame)
+
+    if frames:
+        lookup = pd.concat(frames,ignore_index=True)
+    else:
+        # none of the requested composites exist
+        columns = ['deims_site','admin_zones','zone_id','zone_name','area_ratio']
+        lookup = pd.DataFrame(columns=columns+(['intersection_area'] if with_area else []))
+    for x in ['deims_site','admin_zones']:
+        lookup[x] = lookup[x].astype('category')
+
+    return lookup.set_index('zone_id')
+
+
+@spanned('wf2-batch')
+def aggregateTabularDatasets(dataset,deims_sites=None,admin_zones=None):
+    """Batch wf2 - extract rows from a table for many sites and zones.
+
+    Rather than merging the table once per (site, zones) composite, one
+    lookup of every requested composite is built and the table is
+    joined against it in a single operation.
+
+    dataset: tabular dataset to filter, first column containing zone
+      IDs (pandas.DataFrame)
+    deims_sites: DEIMS site IDs, None for all sites (list(str))
+    admin_zones: zone codes, None for every zone available to each site
+      (list(str))
+
+    Requires a dictionary validated_deims_sites to be available as a
+    free variable - see aggregateTabularDataset.
+
+    Returns pandas.DataFrame in long format: the output of wf2 for each
+    site and zones, stacked, with columns 'deims_site' and
+    'admin_zones' identifying them.
+    """
+
+    lookup = buildCompositeLookup(deims_sites,admin_zones)
+
+    # take name of first column of dataset, assumed to contain IDs
+    right_on_key = dataset.columns[0]
+
+    merged_dataset = lookup.join(dataset.set_index(right_on_key),how='left')
+
+    return merged_dataset.rename_axis('zone_id').reset_index()
+
+
+@spanned('wf2-summary')
+def summariseTabularDataset(dataset,deims_sites=None,admin_zones=None,intensive=None):
+    """Area-weighted totals of a table's numeric columns per site and zones.
+
+    Extensive columns (counts, e.g. births) are apportioned to a site by
+    the fraction of each zone within it, 'area_ratio', and summed.
+    Intensive columns (rates, densities, e.g. births per 1000) are
+    averaged over the zones, weighted by the area of each zone within
+    the site. Missing values are left out of both; a site and zones
+    with no values for a column gives NaN.
+
+    dataset: tabular dataset, first column containing zone IDs and one
+      row per zone (pandas.DataFrame)
+    deims_sites: DEIMS site IDs, None for all sites (list(str))
+    admin_zones: zone codes, None for every zone available to each site
+      (list(str))
+    intensive: names of numeric columns to average rather than sum, all
+      others are treated as extensive (list(str))
+
+    Requires a dictionary validated_deims_sites to be available as a
+    free variable - see aggregateTabularDataset.
+
+    Returns pandas.DataFrame with a row per site and zones, columns
+    'deims_site', 'admin_zones' and one per numeric column of dataset.
+    """
+
+    right_on_key = dataset.columns[0]
+    values = dataset.set_index(right_on_key).select_dtypes('number')
+    if values.columns.empty:
+        raise ValueError('Dataset has no numeric columns to summarise')
+
+    intensive = [] if intensive is None else list(intensive)
+    unknown = set(intensive).difference(values.columns)
+    if unknown:
+        raise ValueError('Not numeric columns of dataset: '+', '.join(sorted(map(str,unknown))))
+    extensive = [x for x in values.columns if x not in set(intensive)]
+
+    lookup = buildCompositeLookup(deims_sites,admin_zones,with_area=True)
+    merged = lookup.join(values,how='inner')
+    groups = [merged['deims_site'],merged['admin_zones']]
+
+    summaries = []
+    if extensive:
+        weighted = merged[extensive].mul(merged['area_ratio'],axis=0)
+        summaries.append(weighted.groupby(groups,observed=True).sum(min_count=1))
+    if intensive:
+        area = merged['intersection_area'].to_numpy()[:,None]
+        present = merged[intensive].notna().to_numpy()
+        numerator = pd.DataFrame(np.nan_to_num(merged[intensive].to_numpy(dtype=float))*area,columns=intensive,index=merged.index)
+        denominator = pd.DataFrame(present*area,columns=intensive,index=merged.index)
+        numerator = numerator.groupby(groups,observed=True).sum()
+        denominator = denominator.groupby(groups,observed=True).sum()
+        summaries.append(numerator/denominator.where(denominator>0))
+
+    summary = pd.concat(summaries,axis=1)[list(values.columns)]
+
+    return summary.reset_index()
+
+
+# helper
+def zonePercentiles(labels,values,count,percentiles):
+    """Percentiles of values per label, by linear interpolation between
+    closest ranks as numpy.percentile does.
+
+    labels: label of each value, an index into count (numpy.ndarray)
+    values: values to summarise (numpy.ndarray)
+    count: number of values per label, indexed by label (numpy.ndarray)
+    percentiles: percentiles to compute, 0-100 (list(float))
+
+    Returns a float array of shape (len(percentiles), len(count)), NaN
+    for labels without values.
+    """
+
+    order = np.lexsort((values,labels))
+    values = values[order].astype(float)
+    start = np.concatenate([[0],np.cumsum(count)[:-1]])
+    has_values = count > 0
+
+    result = np.full((len(percentiles),len(count)),np.nan)
+    for i,q in enumerate(percentiles):
+        position = (count[has_values]-1)*q/100
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        low = values[start[has_values]+lower]
+        high = values[start[has_values]+upper]
+        result[i,has_values] = low + (high-low)*(position-lower)
+
+    return result
+
+
+@spanned('wf3')
+def summariseRasterDataset(dataset,deims_site,admin_zones,band=1,percentiles=(25,50,75)):
+    """wf3 - summarise a raster dataset per zone of a composite site.
+
+    The composite's zones are rasterized once into a grid of labels over
+    the site's window, then the raster is read block by block and each
+    block's pixels are reduced per label with bincount and sorted
+    reductions, so the whole site is summarised in one pass. Masked
+    (e.g. nodata) pixels are left out, as are zones too small to cover
+    a pixel's centre, which get a count of 0 and NaN statistics.
+
+    dataset: filepath to a raster dataset to summarise (str)
+    deims_site: DEIMS site ID (str)
+    admin_zones: zone code (str)
+    band: band of the raster to summarise (int)
+    percentiles: percentiles to compute, 0-100 - unlike the other
+      statistics, these need the site's pixels to be held in memory at
+      once, so pass () for very large sites (list(float))
+
+    Requires a dictionary validated_deims_sites to be available as a
+    free variable - see aggregateTabularDataset.
+
+    Returns pandas.DataFrame shaped like wf2's output, the composite
+    without geometry, with columns 'count', 'sum', 'mean', 'min', 'max'
+    and 'p<percentile>' for each percentile.
+    """
+
+    composite = validated_deims_sites[deims_site]['composites'][admin_zones]
+    percentiles = list(percentiles)
+
+    with rio.open(dataset) as active_dataset:
+        zones = composite.geometry
+        if composite.crs != active_dataset.crs:
+            zones = zones.to_crs(active_dataset.crs)
+        window = siteWindow(active_dataset,zones)
+
+        # label i+1 for the ith row of the composite, 0 outside
+        with span('wf3/rasterize',zones=len(composite)):
+            labels = riofeatures.rasterize(
+                [(x,i+1) for i,x in enumerate(zones) if x is not None and not x.is_empty],
+                out_shape=(window.height,window.width),
+                transform=active_dataset.window_transform(window),
+                fill=0,
+                dtype='int32'
+                )
+
+        n = len(composite) + 1
+        count = np.zeros(n,dtype=np.int64)
+        total = np.zeros(n)
+        minimum = np.full(n,np.inf)
+        maximum = np.full(n,-np.inf)
+        kept = []
+
+        for block in blockWindows(window,active_dataset.block_shapes[band-1]):
+            data = active_dataset.read(band,window=block,masked=True)
+            block_labels = labels[block.row_off-window.row_off:block.row_off-window.row_off+block.height,block.col_off-window.col_off:block.col_off-window.col_off+block.width]
+            inside = (block_labels > 0) & ~np.ma.getmaskarray(data)
+            if not inside.any():
+                continue
+            block_labels = block_labels[inside]
+            values = data.data[inside]
+
+            count += np.bincount(block_labels,minlength=n)
+            total += np.bincount(block_labels,weights=values,minlength=n)
+
+            # min and max over runs of equal labels
+            order = np.argsort(block_labels,kind='stable')
+            sorted_labels = block_labels[order]
+            sorted_values = values[order]
+            starts = np.flatnonzero(np.concatenate([[True],sorted_labels[1:] != sorted_labels[:-1]]))
+            present = sorted_labels[starts]
+            minimum[present] = np.minimum(minimum[present],np.minimum.reduceat(sorted_values,starts))
+            maximum[present] = np.maximum(maximum[present],np.maximum.reduceat(sorted_values,starts))
+
+            if percentiles:
+                kept.append((block_labels,values))
+
+    has_values = count > 0
+    summary = pd.DataFrame(composite.drop(columns=composite.geometry.name))
+    summary['count'] = count[1:]
+    summary['sum'] = np.where(has_values,total,np.nan)[1:]
+    summary['mean'] = np.where(has_values,total/np.maximum(count,1),np.nan)[1:]
+    summary['min'] = np.where(has_values,minimum,np.nan)[1:]
+    summary['max'] = np.where(has_values,maximum,np.nan)[1:]
+
+    if percentiles:
+        if kept:
+            all_labels = np.concatenate([x[0] for x in kept])
+            all_values = np.concatenate([x[1] for x in kept])
+            # values of label 0 were never kept, so drop it from the counts
+            quantiles = zonePercentiles(all_labels-1,all_values,count[1:],percentiles)
+        else:
+            quantiles = np.full((len(percentiles),n-1),np.nan)
+        for q,column in zip(percentiles,quantiles):
+            summary[f'p{q:g}'] = column
+
+    return summary.reset_index(drop=True)
+
+
+# SPATIAL LOOKUP
+# CRS in which site boundaries are held, to be reprojected into the CRS
+# of each raster queried
+SITE_INDEX_CRS = 'EPSG:4326'
+
+
+# helper
+def readTabularIDs(path,sheet=None):
+    """Read only the first column of a table, the zone IDs, as strings.
+
+    path: path to the CSV, Parquet or Excel file (str)
+    sheet: sheet of an Excel file, None for the first (str)
+    """
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension=='.csv':
+        ids = pd.read_csv(path,usecols=[0],dtype=str).iloc[:,0]
+    elif extension=='.parquet':
+        import pyarrow.parquet as pq
+        schema = pq.read_schema(path)
+        ids = pq.read_table(path,columns=[schema.names[0]]).to_pandas().iloc[:,0]
+    elif extension in ('.xlsx','.xlsm'):
+        import openpyxl
+        workbook = openpyxl.load_workbook(path,read_only=True,data_only=True)
+        try:
+            worksheet = workbook.active if sheet is None else workbook[sheet]
+            ids = pd.Series([x[0] for x in worksheet.iter_rows(min_row=2,max_col=1,values_only=True)],dtype=object)
+        finally:
+            workbook.close()
+    else:
+        ids = pd.read_excel(path,sheet_name=0 if sheet is None else sheet,usecols=[0]).iloc[:,0]
+
+    return ids.dropna().map(tabularID)
+
+
+class SiteIndex:
+    """Spatial index of every DEIMS site's boundaries, and lookup of
+    every composite's zone IDs, to find in milliseconds which sites a
+    raster covers and which sites and zones a table has rows for, before
+    cropping or merging anything.
+
+    Site boundaries are read once, when the index is built, and held
+    dissolved in SITE_INDEX_CRS. Overlaps are found in the CRS of the
+    bounds queried: the sites are reprojected into each CRS once, under
+    geopandas' spatial index, since reprojecting a raster's bounds
+    instead fails or comes out wrong for rasters reaching beyond where a
+    CRS is valid, e.g. global ones in an equal-area CRS of Europe. Zone
+    IDs are read with directoryparse.compositeAttributes, without
+    geometry.
+
+    deims_sites: site IDs to index, None for all (list(str))
+    zones: also read every composite's zone IDs, for queryIDs - not
+      needed to check rasters (bool)
+
+    Requires a dictionary validated_deims_sites to be available as a
+    free variable - see cropRasterDataset.
+    """
+
+    def __init__(self,deims_sites=None,zones=True):
+        if deims_sites is None:
+            deims_sites = list(validated_deims_sites)
+
+        self.sites = self._readSites(deims_sites)
+        # sites reprojected into each CRS queried, keyed by CRS
+        self.projected = {}
+        self.zone_ids = None
+        self.zone_counts = None
+        if zones:
+            self._setZoneIDs(self._readZoneIDs(deims_sites))
+
+    def _readSites(self,deims_sites):
+        with span('index/sites',sites=len(deims_sites)):
+            geometries = []
+            for site in deims_sites:
+                boundaries = validated_deims_sites[site]['boundaries']
+                geometries.append(boundaries.to_crs(SITE_INDEX_CRS).unary_union)
+            return gpd.GeoDataFrame({'deims_site': deims_sites},geometry=geometries,crs=SITE_INDEX_CRS)
+
+    def _readZoneIDs(self,deims_sites):
+        with span('index/zones'):
+            frames = []
+            for site in deims_sites:
+                for zones in validated_deims_sites[site]['composites']:
+                    try:
+                        frame = compositeAttributes(validated_deims_sites[site],zones)[['zone_id']]
+                    except KeyError:
+                        # the composite could not be read, see LazyComposites
+                        continue
+                    frame = frame.assign(zone_id=frame['zone_id'].map(tabularID),deims_site=site,admin_zones=zones)
+                    frames.append(frame)
+            if frames:
+                return pd.concat(frames,ignore_index=True)
+            return pd.DataFrame(columns=['zone_id','deims_site','admin_zones'])
+
+    def _setZoneIDs(self,zone_ids):
+        for x in ['deims_site','admin_zones']:
+            zone_ids[x] = zone_ids[x].astype(str).astype('category')
+        self.zone_ids = zone_ids
+        self.zone_counts = zone_ids.groupby(['deims_site','admin_zones'],observed=True)['zone_id'].nunique()
+
+    def addSite(self,deims_site):
+        """Add a site to the index, or re-read it, e.g. after adding it to
+        validated_deims_sites.
+
+        deims_site: DEIMS site ID (str)
+        """
+
+        sites = self.sites[self.sites['deims_site'] != deims_site]
+        self.sites = gpd.GeoDataFrame(pd.concat([sites,self._readSites([deims_site])],ignore_index=True),crs=SITE_INDEX_CRS)
+        self.projected = {}
+        if self.zone_ids is not None:
+            zone_ids = self.zone_ids[self.zone_ids['deims_site'] != deims_site]
+            self._setZoneIDs(pd.concat([zone_ids.astype({'deims_site': str, 'admin_zones': str}),self._readZoneIDs([deims_site])],ignore_index=True))
+
+    def projectedSites(self,crs):
+        """Return the sites reprojected into a CRS, with a spatial index,
+        reprojecting them on the first query in that CRS.
+
+        crs: CRS to reproject into (str/rasterio.crs.CRS)
+
+        Returns a dict of 'sites' (geopandas.GeoDataFrame), 'areas' (of
+        each site in crs) and 'unknown', the IDs of sites which can't be
+        reprojected into crs, e.g. as they lie outside where it is
+        valid (numpy.ndarray).
+        """
+
+        key = str(crs)
+        if key not in self.projected:
+            with span('index/project',crs=key):
+                try:
+                    sites = self.sites.to_crs(crs)
+                    valid = np.isfinite(sites.geometry.bounds.values).all(axis=1)
+                    valid &= (sites.geometry.is_valid & ~sites.geometry.is_empty).values
+                except Exception:
+                    sites = self.sites
+                    valid = np.zeros(len(sites),dtype=bool)
+                known = sites[valid].reset_index(drop=True)
+                # build the spatial index now rather than on the first query
+                known.sindex
+                self.projected[key] = {
+                        'sites': known,
+                        'areas': known.geometry.area.values,
+                        'unknown': self.sites['deims_site'].values[~valid],
+                        }
+
+        return self.projected[key]
+
+    def queryBounds(self,bounds,crs):
+        """Find the sites overlapping a bounding box.
+
+        bounds: (left, bottom, right, top) (tuple)
+        crs: CRS of bounds (str/rasterio.crs.CRS)
+
+        Returns pandas.DataFrame of 'deims_site' and 'fraction', the
+        fraction of the site's area inside the box, largest first,
+        followed by any sites whose overlap is unknown as they can't be
+        reprojected into crs, with a fraction of NaN.
+        """
+
+        projected = self.projectedSites(crs)
+        sites,areas = projected['sites'],projected['areas']
+        query = box(*bounds)
+        candidates = np.sort(sites.sindex.query(query,predicate='intersects'))
+        overlaps = sites.geometry.iloc[candidates].intersection(query).area.values
+        fractions = np.divide(overlaps,areas[candidates],out=np.zeros(len(candidates)),where=areas[candidates] > 0)
+
+        found = pd.DataFrame({
+            'deims_site': np.concatenate([sites['deims_site'].values[candidates],projected['unknown']]),
+            'fraction': np.concatenate([fractions,np.full(len(projected['unknown']),np.nan)]),
+            })
+        return found.sort_values('fraction',ascending=False,kind='stable',na_position='last').reset_index(drop=True)
+
+    def queryRaster(self,dataset):
+        """Find the sites a raster overlaps, see queryBounds.
+
+        dataset: filepath to a raster dataset (str)
+        """
+
+        with rio.open(dataset) as active_dataset:
+            return self.queryBounds(tuple(active_dataset.bounds),active_dataset.crs)
+
+    def queryIDs(self,ids):
+        """Find the sites and zones which have some of a table's rows.
+
+        ids: zone IDs, e.g. the first column of a table (list-like)
+
+        Returns pandas.DataFrame of 'deims_site', 'admin_zones', 'zones'
+        (number of the composite's zones found) and 'fraction' (of the
+        composite's zones found), largest fraction first.
+        """
+
+        if self.zone_ids is None:
+            raise ValueError('the index was built without zones')
+
+        ids = set(pd.Series(list(ids),dtype=object).dropna().map(tabularID))
+        matched = self.zone_ids[self.zone_ids['zone_id'].isin(ids)]
+        zones = matched.groupby(['deims_site','admin_zones'],observed=True)['zone_id'].nunique()
+
+        found = zones.rename('zones').reset_index()
+        found['fraction'] = (zones / self.zone_counts.reindex(zones.index)).values
+        for x in ['deims_site','admin_zones']:
+            found[x] = found[x].astype(str)
+        return found.sort_values('fraction',ascending=False,kind='stable').reset_index(drop=True)
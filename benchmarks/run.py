@@ -0,0 +1,307 @@
+"""Time and measure the memory of loading, composite generation and the
+workflows, offline, against this repository's shapefiles/ and data/ and
+synthetic rasters.
+
+Usage, from the repository root:
+    python benchmarks/run.py [--site ID] [--repeat N] [--raster-sizes N ...]
+        [--only REGEX] [--output results.json] [--baseline FILE]
+        [--save-baseline] [--threshold RATIO]
+
+Each benchmark is run --repeat times, timed with time.perf_counter, then
+once more under tracemalloc to measure its peak traced memory (Python
+and numpy allocations, not GDAL's own). Results are written as JSON to
+--output (default stdout). Given --baseline, median times are compared
+against the baseline's and the script exits with status 1 if any is
+more than --threshold times slower; --save-baseline writes the results
+to the baseline file instead.
+"""
+
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+
+
+# load as app.R does with reticulate's source_python, so that free
+# variables in these files resolve against one shared namespace
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for script in ['instrumentation.py','analyse.py','shapefiles/scripts/shapefile-generator.py','shapefiles/scripts/directoryparse.py']:
+    with open(os.path.join(REPO_ROOT,script)) as f:
+        exec(compile(f.read(),script,'exec'))
+
+SF_ROOT = os.path.join(REPO_ROOT,'shapefiles')
+# the Cairngorms, which has every composite
+DEFAULT_SITE = '1b94503d-285c-4028-a3db-bc78e31dea07'
+
+
+def measure(function,repeat,setup=None):
+    """Time repeat calls of function, then measure the peak memory
+    traced during one more.
+
+    function: what to measure, called without arguments
+    repeat: number of timed calls (int)
+    setup: called without arguments before each call, untimed, e.g.
+      to empty caches
+    """
+
+    seconds = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter()-start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+            'seconds': seconds,
+            'median_seconds': statistics.median(seconds),
+            'min_seconds': min(seconds),
+            'peak_traced_bytes': peak,
+            }
+
+
+def writeSyntheticRaster(path,bounds,size):
+    """Write a single band, tiled GeoTIFF of random values in EPSG:4326,
+    one block at a time.
+
+    path: file to write (str)
+    bounds: (west, south, east, north) to cover (tuple)
+    size: width and height in pixels (int)
+    """
+
+    from rasterio.transform import from_bounds
+
+    rng = np.random.default_rng(size)
+    profile = {
+            'driver': 'GTiff',
+            'width': size,
+            'height': size,
+            'count': 1,
+            'dtype': 'float32',
+            'crs': 'EPSG:4326',
+            'transform': from_bounds(*bounds,size,size),
+            'nodata': -1,
+            'tiled': True,
+            'blockxsize': 256,
+            'blockysize': 256,
+            }
+    with rio.open(path,'w',**profile) as dest:
+        for block in blockWindows(Window(0,0,size,size),(256,256)):
+            dest.write(rng.gamma(2,10,(block.height,block.width)).astype('float32'),1,window=block)
+
+
+def nameFilter(pattern):
+    """Return a predicate for benchmark names matching a regular
+    expression, or matching everything if pattern is None."""
+
+    regex = re.compile(pattern) if pattern else None
+    return lambda name: regex is None or regex.search(name) is not None
+
+
+def benchmarkLoading(results,wanted,repeat,scratch):
+    cache_dir = os.path.join(scratch,'layer-cache')
+    cases = {
+            'loadAllInfo/lazy': lambda: loadAllInfo(SF_ROOT,disk_cache=False),
+            'loadAllInfo/eager-shapefile': lambda: loadAllInfo(SF_ROOT,lazy=False,disk_cache=False),
+            'loadAllInfo/eager-geoparquet': lambda: loadAllInfo(SF_ROOT,lazy=False,disk_cache=cache_dir),
+            'loadAllInfo/serving': lambda: loadAllInfo(SF_ROOT,disk_cache=cache_dir,serving=True),
+            }
+    if wanted('loadAllInfo/eager-geoparquet') or wanted('loadAllInfo/serving'):
+        # build the cached copies first, so that only reads are measured
+        loadAllInfo(SF_ROOT,lazy=False,disk_cache=cache_dir)
+    for name,function in cases.items():
+        if wanted(name):
+            results[name] = measure(function,repeat)
+
+
+def benchmarkDecomposition(results,wanted,repeat,site):
+    for zones in validated_zones:
+        name = f'decomposeSite/{zones}'
+        if not wanted(name):
+            continue
+        zone_boundaries = validated_zones[zones]['boundaries']
+        if zone_boundaries is None:
+            print(f'INFO: no boundaries for {zones} - skipping',file=sys.stderr)
+            continue
+        metadata = validated_zones[zones]['metadata']
+        results[name] = measure(
+                lambda: decomposeSite(validated_deims_sites[site]['boundaries'],zone_boundaries,metadata['IDColumn'],metadata['nameColumn']),
+                repeat
+                )
+
+
+def benchmarkCrop(results,wanted,repeat,site,sizes,scratch):
+    west,south,east,north = validated_deims_sites[site]['boundaries'].to_crs('EPSG:4326').total_bounds
+    # pad so that the site sits inside the raster, as it would in real data
+    pad_x,pad_y = (east-west)/2,(north-south)/2
+    bounds = (west-pad_x,south-pad_y,east+pad_x,north+pad_y)
+    output = os.path.join(scratch,'wf1')
+    os.makedirs(output,exist_ok=True)
+
+    def coldCaches():
+        site_mask_cache.invalidate()
+        render_cache.invalidate()
+
+    for size in sizes:
+        cases = {
+                f'cropRasterDataset/{size}': {'streaming': False, 'render': False},
+                f'cropRasterDataset/{size}-streaming': {'streaming': True, 'render': False},
+                f'cropRasterDataset/{size}-render': {'streaming': False, 'render': True},
+                }
+        if not any([wanted(x) for x in cases]):
+            continue
+        raster = os.path.join(scratch,f'synthetic-{size}.tif')
+        writeSyntheticRaster(raster,bounds,size)
+        for name,options in cases.items():
+            if wanted(name):
+                results[name] = measure(
+                        lambda: cropRasterDataset(raster,site,'Synthetic',output=output,**options),
+                        repeat,
+                        coldCaches
+                        )
+        os.remove(raster)
+
+
+def benchmarkAggregate(results,wanted,repeat,site,scratch):
+    dataset = pd.read_csv(os.path.join(REPO_ROOT,'data','scottish-births-cleaned.csv'),dtype={'DataZone': str})
+    output = os.path.join(scratch,'wf2')
+    os.makedirs(output,exist_ok=True)
+
+    def coldCaches():
+        merge_cache.invalidate()
+        render_cache.invalidate()
+
+    for zones in validated_deims_sites[site]['composites']:
+        for render in [False,True]:
+            name = f'aggregateTabularDataset/{zones}' + ('-render' if render else '')
+            if wanted(name):
+                results[name] = measure(
+                        lambda: aggregateTabularDataset(dataset,site,zones,'2018','Births',render=render,output=output),
+                        repeat,
+                        coldCaches
+                        )
+
+
+def environment():
+    """Describe what the results were measured with."""
+
+    try:
+        commit = subprocess.run(['git','rev-parse','HEAD'],cwd=REPO_ROOT,capture_output=True,text=True,check=True).stdout.strip()
+    except (OSError,subprocess.CalledProcessError):
+        commit = None
+
+    import pandas, geopandas, shapely
+    return {
+            'commit': commit,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'versions': {
+                'numpy': np.__version__,
+                'pandas': pandas.__version__,
+                'geopandas': geopandas.__version__,
+                'shapely': shapely.__version__,
+                'rasterio': rio.__version__,
+                'gdal': rio.__gdal_version__,
+                },
+            }
+
+
+def compare(results,baseline,threshold):
+    """Print the ratio of each median time to the baseline's.
+
+    Returns the names of benchmarks slower than threshold times the
+    baseline.
+    """
+
+    regressions = []
+    for name,result in results.items():
+        if name not in baseline:
+            print(f'{"new":>8} {name}',file=sys.stderr)
+            continue
+        ratio = result['median_seconds']/baseline[name]['median_seconds']
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = ' REGRESSION'
+        print(f'{ratio:7.2f}x {name}{flag}',file=sys.stderr)
+
+    return regressions
+
+
+def main():
+    global validated_zones,validated_deims_sites
+
+    parser = argparse.ArgumentParser(description='Benchmark loading, composite generation and the workflows.')
+    parser.add_argument('--site',default=DEFAULT_SITE,help='DEIMS site to benchmark with (default: the Cairngorms)')
+    parser.add_argument('--repeat',type=int,default=3,help='timed runs of each benchmark (default: 3)')
+    parser.add_argument('--raster-sizes',type=int,nargs='+',default=[1024,4096],help='sides of the synthetic rasters in pixels (default: 1024 4096)')
+    parser.add_argument('--only',default=None,help='only run benchmarks whose names match this regular expression')
+    parser.add_argument('--output',default=None,help='write results here instead of stdout')
+    parser.add_argument('--baseline',default=None,help='baseline results to compare against or save to')
+    parser.add_argument('--save-baseline',action='store_true',help='write the results to --baseline')
+    parser.add_argument('--threshold',type=float,default=1.25,help='slowdown relative to the baseline reported as a regression (default: 1.25)')
+    args = parser.parse_args()
+
+    wanted = nameFilter(args.only)
+    results = {}
+    scratch = tempfile.mkdtemp(prefix='benchmarks-')
+    try:
+        benchmarkLoading(results,wanted,args.repeat,scratch)
+        # the workflows find these as free variables
+        validated_zones,validated_deims_sites = loadAllInfo(SF_ROOT,lazy=False,disk_cache=os.path.join(scratch,'layer-cache'))
+        benchmarkDecomposition(results,wanted,args.repeat,args.site)
+        benchmarkCrop(results,wanted,args.repeat,args.site,args.raster_sizes,scratch)
+        benchmarkAggregate(results,wanted,args.repeat,args.site,scratch)
+    finally:
+        shutil.rmtree(scratch,ignore_errors=True)
+
+    report = {
+            'environment': environment(),
+            'options': {'site': args.site, 'repeat': args.repeat, 'raster_sizes': args.raster_sizes},
+            # ru_maxrss is in kilobytes on Linux
+            'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024,
+            'results': results,
+            }
+
+    if args.output is not None:
+        with open(args.output,'w') as f:
+            json.dump(report,f,indent=4)
+    else:
+        json.dump(report,sys.stdout,indent=4)
+        print()
+
+    if args.baseline is None:
+        return 0
+    if args.save_baseline:
+        with open(args.baseline,'w') as f:
+            json.dump(report,f,indent=4)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results,baseline['results'],args.threshold)
+    print(f'{len(regressions)} regression(s)' if regressions else 'no regressions',file=sys.stderr)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""Opt-in timing and memory measurement of the stages of workflows.
+
+Exports:
+    - span, to wrap a named stage of work, and spanned, to wrap a
+        whole function
+    - collectSpans, to gather the spans recorded while it is active and
+        return them, e.g. to R
+    - recordSpans, to pass spans recorded in another process, e.g. a
+        worker of jobservice.py, to the active collectors
+    - setSpanCallback, to receive every span as it finishes, and
+        logSpan, a callback writing spans to the logging module as JSON
+    - enableSpanLogging, to log every span from now on
+
+Spans are only measured while a collector is active or a callback is
+set, so wrapping code in span costs next to nothing otherwise.
+"""
+
+
+import json
+import time
+import functools
+import logging
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+# per-thread stack of open spans and list of active collectors
+span_state = threading.local()
+# called with every finished span, see setSpanCallback
+span_callback = None
+
+
+class SpanCollector:
+    """Collects the spans which finish in this thread between start and
+    stop, or inside a with block.
+
+    memory: trace allocations with tracemalloc so that spans report
+      their peak memory, at some cost in speed (bool)
+    """
+
+    def __init__(self,memory=False):
+        self.memory = memory
+        self.spans = []
+        self._started_tracing = False
+
+    def start(self):
+        if not hasattr(span_state,'collectors'):
+            span_state.collectors = []
+        span_state.collectors.append(self)
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return self
+
+    def stop(self):
+        """Stop collecting and return the spans, in the order they
+        finished (list(dict))."""
+
+        span_state.collectors.remove(self)
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return self.spans
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,*exc_info):
+        self.stop()
+        return False
+
+
+def collectSpans(memory=False):
+    """Return a SpanCollector, to use as a context manager in Python:
+
+        with collectSpans() as collector:
+            cropRasterDataset(...)
+        collector.spans
+
+    or with start and stop from R:
+
+        collector <- collectSpans()$start()
+        cropRasterDataset(...)
+        spans <- collector$stop()
+    """
+
+    return SpanCollector(memory)
+
+
+def recordSpans(records):
+    """Add spans recorded elsewhere, e.g. by a worker process, to the
+    collectors active in this thread. They are not passed to the
+    callback, which the process recording them will have called.
+
+    records: spans as recorded by span (list(dict))
+    """
+
+    for collector in getattr(span_state,'collectors',[]):
+        collector.spans.extend(records)
+
+
+def setSpanCallback(callback):
+    """Call callback(span) with every span as it finishes, in any
+    thread, or stop if callback is None. Returns the previous callback.
+
+    callback: function taking a span (dict), e.g. logSpan
+    """
+
+    global span_callback
+    previous = span_callback
+    span_callback = callback
+    return previous
+
+
+def logSpan(record):
+    """Log a span as JSON to the 'instrumentation' logger, at INFO."""
+
+    logging.getLogger('instrumentation').info(json.dumps(record,default=str))
+
+
+def enableSpanLogging(level=logging.INFO):
+    """Log every span with logSpan, configuring logging to write to
+    stderr if nothing else has.
+
+    level: level of messages to show (int/str)
+    """
+
+    logging.basicConfig(level=level)
+    setSpanCallback(logSpan)
+
+
+@contextmanager
+def span(name,**attributes):
+    """Measure a stage of work, e.g.
+
+        with span('wf1/crop',site=region):
+            ...
+
+    Each span records its 'name', the name of the span it is nested in
+    ('parent'), its 'attributes', when it started ('start', seconds since
+    the epoch), 'wall_seconds', 'cpu_seconds' (of the whole process),
+    'peak_traced_bytes' (the most memory allocated at once above what
+    was allocated when it started, if a collector traces memory,
+    otherwise None), 'max_rss_bytes' (the process's maximum resident
+    memory so far) and 'error' (the name of the exception which ended
+    it, if any).
+    """
+
+    collectors = getattr(span_state,'collectors',None)
+    if not collectors and span_callback is None:
+        yield
+        return
+
+    if not hasattr(span_state,'stack'):
+        span_state.stack = []
+    stack = span_state.stack
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # peaks are shared between nested spans, so record the
+        # parent's before resetting
+        current,peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]['peak'] = max(stack[-1]['peak'],peak)
+        if hasattr(tracemalloc,'reset_peak'):
+            tracemalloc.reset_peak()
+    frame = {'name': name, 'base': current if tracing else 0, 'peak': 0}
+    stack.append(frame)
+
+    record = {
+            'name': name,
+            'parent': stack[-2]['name'] if len(stack) > 1 else None,
+            'attributes': attributes,
+            'start': time.time(),
+            }
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        record['wall_seconds'] = time.perf_counter() - wall_start
+        record['cpu_seconds'] = time.process_time() - cpu_start
+        stack.pop()
+        if tracing and tracemalloc.is_tracing():
+            peak = max(frame['peak'],tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'],peak)
+            record['peak_traced_bytes'] = peak - frame['base']
+        else:
+            record['peak_traced_bytes'] = None
+        # ru_maxrss is in kilobytes on Linux
+        record['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+        record['error'] = error
+
+        for collector in getattr(span_state,'collectors',[]):
+            collector.spans.append(record)
+        callback = span_callback
+        if callback is not None:
+            try:
+                callback(record)
+            except Exception as e:
+                logging.getLogger('instrumentation').warning(f'span callback failed: {e}')
+
+
+def spanned(name):
+    """Decorate a function so that each call is measured as a span."""
+
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args,**kwargs):
+            with span(name):
+                return function(*args,**kwargs)
+        return wrapper
+
+    return decorate
@@ -1,8 +1,26 @@
 """Intended for use by Shiny only - relies on implicit imports."""
 
 
+import os
+
+
+# GeoPackage store to use instead of the shapefiles directory, if any -
+# see directoryparse.saveToStore
+shapefile_store = os.environ.get('SHAPEFILE_STORE') or None
+# load the compact serving registry instead, e.g. in many workflow
+# workers - see directoryparse.loadAllInfo
+shapefile_serving = bool(os.environ.get('SHAPEFILE_SERVING'))
+# most unpacked GeoDataFrames to hold at once when serving, keeping the
+# compact registry compact
+SERVING_MAX_ENTRIES = 4
+
 # read what DEIMS sites and zones are available from filesystem
-validated_zones,validated_deims_sites = loadAllInfo('shapefiles')
+validated_zones,validated_deims_sites = loadAllInfo(
+        'shapefiles',
+        max_entries=SERVING_MAX_ENTRIES if shapefile_serving else 32,
+        store=shapefile_store,
+        serving=shapefile_serving,
+        )
 
 
 # construct metadata for interface and workflows
@@ -20,16 +38,40 @@ deims_site_zone_options = {
             } for x in list(validated_deims_sites)
         }
 
-# wrapper function to add site and update dictionaries in one go
-def addSiteToInterface(deims_site_id_suffix):
+# spatial index of the sites, without zone IDs, to check rasters
+# against - built ahead of time by app.R with buildSiteIndex, so that
+# the first crop doesn't wait for it, but not by workflow workers, which
+# never need it - see analyse.SiteIndex
+site_index = None
+
+def buildSiteIndex():
+    global site_index
+
+    site_index = SiteIndex(zones=False)
+
+def siteIndex():
+    if site_index is None:
+        buildSiteIndex()
+    return site_index
+
+# maps friendly names to IDs of the sites a raster overlaps, most covered first
+def rasterSiteOptions(dataset_path):
+    found = siteIndex().queryRaster(dataset_path)
+    return {
+            validated_deims_sites[x]['metadata']['displayName']: x for x in found['deims_site']
+            }
+
+# whether a raster overlaps a site at all, to skip crops which would fail -
+# True if the site can't be reprojected into the raster's CRS to tell
+def rasterCoversSite(dataset_path,deims_site):
+    return deims_site in set(siteIndex().queryRaster(dataset_path)['deims_site'])
+
+# add a new site to the global dicts
+def registerDeimsSite(new_site):
     global validated_deims_sites
     global deims_site_name_mappings
     global deims_site_zone_options
 
-    # create and save site
-    new_site = getNewDeimsSite(deims_site_id_suffix,False)
-    saveDeimsSite(new_site,'shapefiles/deims')
-
     # add metadata to global dicts
     validated_deims_sites[new_site['metadata']['id']['suffix']] = new_site
     deims_site_name_mappings[new_site['metadata']['displayName']] = new_site['metadata']['id']['suffix']
@@ -37,3 +79,21 @@ def addSiteToInterface(deims_site_id_suffix):
     deims_site_zone_options[new_site['metadata']['id']['suffix']] = {
             validated_zones[x]['metadata']['displayName']: x for x in list(new_site['composites'])
             }
+    # add boundaries to the spatial index, if built
+    if site_index is not None:
+        site_index.addSite(new_site['metadata']['id']['suffix'])
+
+# wrapper function to add site and update dictionaries in one go
+def addSiteToInterface(deims_site_id_suffix):
+    # create and save site
+    new_site = getNewDeimsSite(deims_site_id_suffix,False)
+    saveDeimsSite(new_site,'shapefiles/deims',store=shapefile_store)
+
+    registerDeimsSite(new_site)
+    return new_site
+
+# add a site created by an addSiteToInterface job in a worker (see
+# jobservice.py) to this process, and have the other workers reload
+def finishAddingSite(job_service,job_id):
+    registerDeimsSite(job_service.result(job_id))
+    job_service.invalidate()
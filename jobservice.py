@@ -0,0 +1,384 @@
+"""A pool of warm worker processes which run workflows for the interface,
+so that a long crop or a new DEIMS site doesn't block every session.
+
+Exports:
+    - JobService, the pool, with submit, poll, result and cancel
+
+Each worker loads the same scripts as app.R, including interface.py and
+so the registry of sites and zones, once when it starts, then runs jobs
+by function name, e.g.
+
+    jobs = JobService(processes=2)
+    job = jobs.submit('cropRasterDataset',path,site,name,output_root=directory)
+    jobs.poll(job)      # 'pending', 'running', 'done', 'failed' or 'cancelled'
+    jobs.result(job)
+    jobs.output(job)    # directory the job wrote its files to
+
+The spans (see instrumentation.py) recorded while a worker runs a job
+are sent back with its result, kept in the job as 'spans' and passed
+to the collectors active in this process (using recordSpans, if it has
+been sourced) when the service receives the result.
+
+Workers are started with the 'spawn' method rather than forked from the
+R process. Nothing runs in the background in this process: finished jobs
+are collected and waiting jobs handed to idle workers whenever the
+service is called.
+
+This is a module to import (e.g. with reticulate's import_from_path)
+rather than a script to source, so that workers can find workerLoop.
+"""
+
+
+import os
+import sys
+import time
+import pickle
+import hashlib
+import itertools
+import multiprocessing
+from multiprocessing.connection import wait
+
+
+# scripts each worker loads, in the order app.R sources them
+WORKER_SCRIPTS = [
+        'instrumentation.py',
+        'analyse.py',
+        'shapefiles/scripts/shapefile-generator.py',
+        'shapefiles/scripts/directoryparse.py',
+        'interface.py',
+        ]
+# statuses of jobs which have not finished
+UNFINISHED = ('pending','running')
+
+# namespace the scripts are loaded into, in a worker
+worker_namespace = {}
+
+
+# helper
+def loadScripts(scripts):
+    """Execute scripts in worker_namespace, as source_python would."""
+
+    for script in scripts:
+        with open(script) as f:
+            exec(compile(f.read(),script,'exec'),worker_namespace)
+
+
+# helper
+def workerLoop(root,connection,generation):
+    """Body of a worker process: load the scripts, then run jobs sent
+    over connection until told to stop.
+
+    root: directory of app.R, which the scripts expect to run in (str)
+    connection: end of a Pipe to the service (Connection)
+    generation: version of the registry loaded, see
+      JobService.invalidate (int)
+    """
+
+    try:
+        os.chdir(root)
+        worker_namespace['__name__'] = 'jobworker'
+        loadScripts(WORKER_SCRIPTS)
+        if os.environ.get('WORKFLOW_SPANS'):
+            worker_namespace['enableSpanLogging']()
+    except Exception as e:
+        connection.send(('failed',None,f'{type(e).__name__}: {e}',[]))
+        return
+    connection.send(('ready',None,None,[]))
+
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        job_id,job_generation,payload = message
+        collector = worker_namespace['collectSpans']().start()
+        try:
+            # sites or zones have been added since the registry was loaded
+            if job_generation != generation:
+                loadScripts(['interface.py'])
+                generation = job_generation
+            function,args,kwargs = pickle.loads(payload)
+            reply = ('done',job_id,worker_namespace[function](*args,**kwargs))
+        except Exception as e:
+            reply = ('failed',job_id,f'{type(e).__name__}: {e}')
+        spans = collector.stop()
+        try:
+            connection.send(reply+(spans,))
+        except Exception as e:
+            # the result could not be pickled, so nothing was sent
+            connection.send(('failed',job_id,f'{type(e).__name__}: {e}',spans))
+
+
+class JobService:
+    """Pool of worker processes running workflow functions by name.
+
+    processes: number of workers, or 0 to run each job in this process
+      as it is submitted, using the functions sourced into __main__ (int)
+    root: directory of app.R (str)
+    python: Python executable for the workers, by default
+      sys.executable - under reticulate, the virtualenv's python (str)
+    warm: wait for every worker to load the scripts before returning
+      (bool)
+    max_finished: number of finished jobs to remember, oldest forgotten
+      first (int)
+    """
+
+    def __init__(self,processes=2,root='.',python=None,warm=True,max_finished=256):
+        self.processes = processes
+        self.root = os.path.abspath(root)
+        self.max_finished = max_finished
+        self.generation = 0
+        self.jobs = {}
+        self.keys = {}
+        self.queue = []
+        self.workers = []
+        self._ids = itertools.count(1)
+
+        if not processes:
+            return
+
+        # workers import this module to find workerLoop
+        module_dir = os.path.dirname(os.path.abspath(__file__))
+        if module_dir not in sys.path:
+            sys.path.append(module_dir)
+        self._context = multiprocessing.get_context('spawn')
+        if python is not None:
+            self._context.set_executable(python)
+
+        for i in range(processes):
+            self._spawn(i)
+        if warm:
+            while any([x['state'] == 'warming' for x in self.workers]):
+                self._pump(None)
+
+    def _spawn(self,slot):
+        connection,child_connection = self._context.Pipe()
+        process = self._context.Process(target=workerLoop,args=(self.root,child_connection,self.generation),daemon=True)
+        process.start()
+        child_connection.close()
+        self.workers.append({'process': process, 'connection': connection, 'state': 'warming', 'job': None, 'slot': slot})
+
+    def _finish(self,job_id,status,value):
+        job = self.jobs[job_id]
+        job['status'] = status
+        job['finished'] = time.time()
+        if status == 'done':
+            job['result'] = value
+        else:
+            job['error'] = value
+
+        finished = sorted([x for x in self.jobs if self.jobs[x]['status'] not in UNFINISHED],key=lambda x: self.jobs[x]['finished'])
+        for x in finished[:max(0,len(finished)-self.max_finished)]:
+            if self.keys.get(self.jobs[x]['key']) == x:
+                del self.keys[self.jobs[x]['key']]
+            del self.jobs[x]
+
+    def _lost(self,worker,error):
+        """Replace a worker which exited, failing its job."""
+
+        self.workers.remove(worker)
+        worker['connection'].close()
+        worker['process'].join(1)
+        if self.jobs.get(worker['job'],{}).get('status') == 'running':
+            self._finish(worker['job'],'failed',error)
+        # the replacement takes the same slot, so routed jobs still go there
+        self._spawn(worker['slot'])
+
+    def _pump(self,timeout=0):
+        """Collect messages from workers, waiting up to timeout seconds
+        (None for ever) for the first, then hand waiting jobs to idle
+        workers."""
+
+        connections = {id(x['connection']): x for x in self.workers}
+        for connection in wait([x['connection'] for x in self.workers],timeout):
+            worker = connections[id(connection)]
+            try:
+                kind,job_id,value,spans = connection.recv()
+            except (EOFError,OSError):
+                if worker['state'] != 'warming':
+                    self._lost(worker,'worker exited unexpectedly')
+                    continue
+                # replacing a worker which dies while loading the scripts
+                # would only start another which dies the same way
+                kind,job_id,value = 'failed',None,'worker exited while starting'
+            if job_id is None and kind == 'failed':
+                # a worker which can't load the scripts won't do better
+                # if replaced
+                self.workers.remove(worker)
+                worker['connection'].close()
+                worker['process'].join(1)
+                raise RuntimeError(f'worker could not load the scripts: {value}')
+            if kind != 'ready' and self.jobs.get(job_id,{}).get('status') == 'running':
+                self.jobs[job_id]['spans'] = spans
+                self._finish(job_id,kind,value)
+                recordSpans = getattr(sys.modules['__main__'],'recordSpans',None)
+                if recordSpans is not None:
+                    recordSpans(spans)
+            worker['state'] = 'idle'
+            worker['job'] = None
+
+        idle = {x['slot']: x for x in self.workers if x['state'] == 'idle'}
+        for job_id in list(self.queue):
+            if not idle:
+                break
+            job = self.jobs[job_id]
+            if job['slot'] is None:
+                worker = idle.pop(next(iter(idle)))
+            elif job['slot'] in idle:
+                worker = idle.pop(job['slot'])
+            else:
+                # wait for the worker it is routed to
+                continue
+            self.queue.remove(job_id)
+            worker['connection'].send((job_id,self.generation,job['payload']))
+            worker['state'] = 'busy'
+            worker['job'] = job_id
+            job['status'] = 'running'
+            job['started'] = time.time()
+
+    def submit(self,function,*args,output_root=None,route=None,**kwargs):
+        """Queue a call of a function defined by the scripts, returning
+        the ID of its job.
+
+        A call identical to a job which has not failed or been cancelled
+        returns that job's ID instead of running again.
+
+        function: name of the function (str)
+        args, kwargs: its arguments, which must be picklable
+        output_root: directory in which to give the call a directory of
+          its own, passed to the function as output (see output) so that
+          calls writing files never overwrite each other's (str)
+        route: picklable key of what the call works on; calls with the
+          same route always run in the same worker, so that caches held
+          by the scripts (e.g. merge_cache, render_cache) are hit rather
+          than filled again in every worker
+        """
+
+        key = hashlib.sha1(pickle.dumps((function,args,kwargs,output_root))).hexdigest()
+        if key in self.keys and self.jobs[self.keys[key]]['status'] in UNFINISHED+('done',):
+            return self.keys[key]
+
+        output = None
+        if output_root is not None:
+            # identical calls write identical files, so can share one
+            output = os.path.join(output_root,key[:16])
+            kwargs['output'] = output
+        payload = pickle.dumps((function,args,kwargs))
+
+        job_id = f'job-{next(self._ids)}'
+        self.jobs[job_id] = {
+                'function': function,
+                'key': key,
+                'payload': payload,
+                'output': output,
+                'slot': None if route is None or not self.processes else int(hashlib.sha1(pickle.dumps(route)).hexdigest(),16) % self.processes,
+                'status': 'pending',
+                'submitted': time.time(),
+                }
+        self.keys[key] = job_id
+
+        if not self.processes:
+            try:
+                self._finish(job_id,'done',getattr(sys.modules['__main__'],function)(*args,**kwargs))
+            except Exception as e:
+                self._finish(job_id,'failed',f'{type(e).__name__}: {e}')
+            return job_id
+
+        self.queue.append(job_id)
+        self._pump()
+        return job_id
+
+    def poll(self,job_id):
+        """Return the status of a job without waiting: 'pending',
+        'running', 'done', 'failed' or 'cancelled'."""
+
+        self._pump()
+        return self.jobs[job_id]['status']
+
+    def result(self,job_id,timeout=None):
+        """Return the result of a job, waiting up to timeout seconds (None
+        for ever) for it to finish.
+
+        Raises RuntimeError if the job failed or was cancelled, and
+        TimeoutError if it is still unfinished after timeout.
+        """
+
+        deadline = None if timeout is None else time.monotonic()+timeout
+        self._pump()
+        while self.jobs[job_id]['status'] in UNFINISHED:
+            remaining = None if deadline is None else deadline-time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(f'{job_id} is still {self.jobs[job_id]["status"]}')
+            self._pump(remaining)
+
+        job = self.jobs[job_id]
+        if job['status'] == 'done':
+            return job['result']
+        if job['status'] == 'cancelled':
+            raise RuntimeError(f'{job_id} was cancelled')
+        raise RuntimeError(f'{job["function"]} failed: {job["error"]}')
+
+    def output(self,job_id):
+        """Return the directory given to a job as output, or None if it
+        was submitted without output_root."""
+
+        return self.jobs[job_id]['output']
+
+    def cancel(self,job_id):
+        """Cancel a job, stopping (and replacing) its worker if it is
+        running. Returns whether it was cancelled, i.e. False if it had
+        already finished."""
+
+        self._pump()
+        job = self.jobs[job_id]
+        if job['status'] == 'pending':
+            self.queue.remove(job_id)
+        elif job['status'] != 'running':
+            return False
+        self._finish(job_id,'cancelled',None)
+
+        for worker in [x for x in self.workers if x['job'] == job_id]:
+            worker['process'].terminate()
+            self._lost(worker,None)
+
+        return True
+
+    def invalidate(self):
+        """Make workers reload the registry (interface.py) before their
+        next job, e.g. after a site has been added."""
+
+        self.generation += 1
+
+    def status(self):
+        """Summarise the workers and jobs, as dicts of counts by state."""
+
+        self._pump()
+        workers = {}
+        for x in self.workers:
+            workers[x['state']] = workers.get(x['state'],0)+1
+        jobs = {}
+        for x in self.jobs.values():
+            jobs[x['status']] = jobs.get(x['status'],0)+1
+
+        return {'workers': workers, 'jobs': jobs}
+
+    def shutdown(self,timeout=5):
+        """Stop the workers, cancelling any unfinished jobs."""
+
+        for job_id in [x for x in self.jobs if self.jobs[x]['status'] in UNFINISHED]:
+            self._finish(job_id,'cancelled',None)
+        self.queue = []
+        for worker in self.workers:
+            try:
+                worker['connection'].send(None)
+            except OSError:
+                pass
+        for worker in self.workers:
+            worker['process'].join(timeout)
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+            worker['connection'].close()
+        self.workers = []
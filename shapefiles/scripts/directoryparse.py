@@ -5,12 +5,34 @@ Exports:
     - saveDeimsSite to save data to a directory
     - loadDirectory to load data from a directory
     - loadAllInfo to load multiple directories into useable dictionaries
+    - findZoneDirectories to locate zones without loading them
+    - GeometryCache, LazyDirectory and LazyComposites, which let
+        loadAllInfo defer reading boundaries until they are used
+    - readLayer to read a shapefile through a persistent GeoParquet
+        cache
+    - geometryTier to get simplified boundaries for plotting, see
+        GEOMETRY_TIERS
+    - PackedDirectory and compositeAttributes, for a compact registry
+        serving workflows (see loadAllInfo's serving)
+    - saveToStore, loadStore and queryStore to keep sites and zones in
+        a single spatially indexed GeoPackage instead of directories
 """
 
 
 import os
 import json
+import sqlite3
+import hashlib
+import zipfile
+import tempfile
+import threading
+from contextlib import closing
+from collections import OrderedDict
+from collections.abc import Mapping
 
+import numpy as np
+import pandas as pd
+import shapely.wkb
 import geopandas as gpd
 
 
@@ -33,15 +55,27 @@ def bootstrapDeimsDirectory(deims_site_id_suffix,deims_dir):
 
 
 # utility
-def saveDeimsSite(deims_site,base_dir):
+def saveDeimsSite(deims_site,base_dir,store=None):
     """Save a DEIMS site in a directory of sites.
 
     deims_site: site to save (dict of 'metadata', 'boundaries' and
       'composites')
     base_dir: directory in which to save - note that when saving
       multiple sites, use the same base_dir each time (str)
+    store: GeoPackage to save to instead of base_dir, see saveToStore
+      (str)
     """
 
+    if store is not None:
+        saveToStore(
+                store,
+                deims_site['metadata']['id']['suffix'],
+                'deims',
+                deims_site['metadata'],
+                dict(deims_site['composites'],boundaries=deims_site['boundaries'])
+                )
+        return
+
     # do we need base dir to exist? Probably not
     target_dir = bootstrapDeimsDirectory(deims_site['metadata']['id']['suffix'],base_dir)
 
@@ -51,15 +85,761 @@ def saveDeimsSite(deims_site,base_dir):
 
     # boundaries
     deims_site['boundaries'].to_file(f'{target_dir}/boundaries.shp.zip')
+    saveGeometryTiers(deims_site['boundaries'],f'{target_dir}/boundaries.shp.zip')
 
     # composites
     for x in list(deims_site['composites']):
         os.makedirs(f'{target_dir}/composites/{x}',exist_ok=True)
         deims_site['composites'][x].to_file(f'{target_dir}/composites/{x}/boundaries.shp.zip')
+        removeUnzippedLayer(f'{target_dir}/composites/{x}')
+        saveGeometryTiers(deims_site['composites'][x],f'{target_dir}/composites/{x}/boundaries.shp.zip')
+
+
+# shapefile components hashed when a layer is an unzipped directory
+SHAPEFILE_EXTENSIONS = ('.shp','.shx','.dbf','.prj','.cpg')
+
+
+# helper
+def layerSourceFiles(source):
+    """List the files which make up a layer, i.e. a zipped shapefile
+    or a directory containing an unzipped one.
+
+    source: path to a .shp.zip file or a shapefile directory (str)
+    """
+
+    if os.path.isdir(source):
+        return sorted([
+            os.path.join(source,x) for x in os.listdir(source)
+            if x.startswith('boundaries.') and x.endswith(SHAPEFILE_EXTENSIONS)
+            ])
+    return [source]
+
+
+# helper
+def removeUnzippedLayer(directory):
+    """Delete the parts of an unzipped shapefile layer from a directory,
+    e.g. once it has been replaced by a boundaries.shp.zip, which
+    readers would otherwise keep passing over for the stale directory
+    (see compositeSource).
+
+    directory: directory of the layer (str)
+    """
+
+    for x in layerSourceFiles(directory):
+        os.remove(x)
+
+
+# helper
+def layerFileStats(source):
+    """List [name, size, mtime] of each file of a layer, the part of its
+    fingerprint which needs no hashing.
+
+    source: path to a .shp.zip file or a shapefile directory (str)
+    """
+
+    files = []
+    for x in layerSourceFiles(source):
+        stat = os.stat(x)
+        files.append([os.path.basename(x),stat.st_size,stat.st_mtime_ns])
+
+    return files
+
+
+# helper
+def fingerprintLayer(source,known=None):
+    """Describe the files of a layer by name, size, mtime and SHA-256.
+
+    If known (a previous fingerprint) has the same names, sizes and
+    mtimes it is returned as-is, skipping the hash.
+
+    source: path to a .shp.zip file or a shapefile directory (str)
+    known: previous result of this function (dict)
+    """
+
+    files = layerFileStats(source)
+    if known is not None and known.get('files') == files:
+        return known
+
+    digest = hashlib.sha256()
+    for x in layerSourceFiles(source):
+        with open(x,'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20),b''):
+                digest.update(chunk)
+
+    return {'files': files, 'sha256': digest.hexdigest()}
+
+
+# helper
+def layerCachePaths(source,disk_cache):
+    """Return paths of the cached GeoParquet copy of a layer and of
+    the JSON fingerprint describing what it was built from.
+
+    source: path to a .shp.zip file or a shapefile directory (str)
+    disk_cache: True to cache next to the source, or a directory in
+      which to keep all cached layers (bool/str)
+    """
+
+    if disk_cache is True:
+        if os.path.isdir(source):
+            stem = os.path.join(source,'boundaries.cache')
+        else:
+            # e.g. boundaries.cache, or boundaries-coarse.cache for a tier
+            stem = os.path.join(os.path.dirname(source),os.path.basename(source).split('.')[0]+'.cache')
+    else:
+        key = hashlib.sha1(os.path.abspath(source).encode('utf-8')).hexdigest()
+        stem = os.path.join(disk_cache,key)
+
+    return (stem+'.parquet',stem+'.json')
+
+
+# helper
+def readLayerFingerprint(sidecar_path):
+    try:
+        with open(sidecar_path) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return None
+
+
+# helper
+def writeLayerCache(layer,source,disk_cache,fingerprint):
+    """Atomically write a layer and its fingerprint to the cache.
+
+    Failure, e.g. on a read-only filesystem, is reported and ignored.
+    """
+
+    cached_path,sidecar_path = layerCachePaths(source,disk_cache)
+    cache_dir = os.path.dirname(cached_path)
+    tmp_path = None
+    try:
+        os.makedirs(cache_dir,exist_ok=True)
+        fd,tmp_path = tempfile.mkstemp(suffix='.parquet',dir=cache_dir)
+        os.close(fd)
+        layer.to_parquet(tmp_path)
+        os.replace(tmp_path,cached_path)
+        fd,tmp_path = tempfile.mkstemp(suffix='.json',dir=cache_dir)
+        with os.fdopen(fd,'w') as f:
+            json.dump(fingerprint,f)
+        os.replace(tmp_path,sidecar_path)
+    except Exception as e:
+        print(f'INFO: could not cache layer {source} ({e}) - continuing')
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# helper
+def layerCacheStatus(source,disk_cache=True,rehash=False):
+    """Check the cached copy of a layer without reading either.
+
+    source: path to a .shp.zip file or a shapefile directory (str)
+    disk_cache: as for layerCachePaths (bool/str)
+    rehash: hash the source even if size and mtime are unchanged (bool)
+
+    Returns one of 'ok', 'stale' or 'missing'.
+    """
+
+    cached_path,sidecar_path = layerCachePaths(source,disk_cache)
+    known = readLayerFingerprint(sidecar_path)
+    if known is None or not os.path.isfile(cached_path):
+        return 'missing'
+    fingerprint = fingerprintLayer(source,None if rehash else known)
+    if fingerprint['sha256'] != known['sha256']:
+        return 'stale'
+    return 'ok'
+
+
+# utility
+def readLayer(source,disk_cache=True):
+    """Read a shapefile layer, via a persistent GeoParquet cache.
+
+    The first read of a layer writes a GeoParquet copy along with a
+    fingerprint of the source files, hashed after the read rather than
+    before it as there is nothing to compare with yet. Later reads use
+    the copy while the source is unchanged: sizes and mtimes are
+    compared first and the source is only re-hashed if they differ, so
+    a touched but otherwise identical source does not trigger a rebuild.
+
+    source: path to a .shp.zip file or a shapefile directory (str)
+    disk_cache: True to cache next to the source, a directory in which
+      to keep all cached layers, or False to read the source directly
+      (bool/str)
+    """
+
+    shapefile_path = source if os.path.isdir(source) else 'zip://'+source
+    if not disk_cache:
+        return gpd.read_file(shapefile_path)
+
+    cached_path,sidecar_path = layerCachePaths(source,disk_cache)
+    known = readLayerFingerprint(sidecar_path)
+
+    fingerprint = None
+    if known is not None and os.path.isfile(cached_path):
+        fingerprint = fingerprintLayer(source,known)
+        if fingerprint['sha256'] == known['sha256']:
+            try:
+                layer = gpd.read_parquet(cached_path)
+            except Exception as e:
+                print(f'INFO: cached copy of {source} unreadable ({e}) - rebuilding')
+            else:
+                # only mtimes changed, record them to skip hashing next time
+                if fingerprint is not known:
+                    writeLayerCache(layer,source,disk_cache,fingerprint)
+                return layer
+
+    if fingerprint is not None:
+        layer = gpd.read_file(shapefile_path)
+        writeLayerCache(layer,source,disk_cache,fingerprint)
+        return layer
+
+    # nothing cached to compare with, so hash only after reading, and
+    # only cache if the source didn't change while it was read
+    files = layerFileStats(source)
+    layer = gpd.read_file(shapefile_path)
+    fingerprint = fingerprintLayer(source)
+    if fingerprint['files'] == files:
+        writeLayerCache(layer,source,disk_cache,fingerprint)
+
+    return layer
+
+
+# helper
+def readMetadata(directory,required_metadata):
+    """Read and check 'metadata.json' from a directory.
+
+    directory: directory containing metadata.json (str/path)
+    required_metadata: keys which must be present (list(str))
+    """
+
+    with open(directory+'/metadata.json') as f:
+        raw_metadata = f.read()
+    metadata = json.loads(raw_metadata)
+
+    checkMetadata(metadata,required_metadata)
+
+    return metadata
+
+
+# helper
+def checkMetadata(metadata,required_metadata):
+    """Check metadata has the required keys.
+
+    metadata: metadata of a site or zone (dict)
+    required_metadata: keys which must be present (list(str))
+    """
+
+    # check for required keys
+    keys = list(metadata)
+    if not all([x in keys for x in required_metadata]):
+        print('Metadata missing required attributes')
+        raise Exception
+
+
+# helper
+def readBoundaries(directory,boundaries_required,disk_cache=True):
+    """Read 'boundaries.shp.zip' from a directory.
+
+    directory: directory containing boundaries.shp.zip (str/path)
+    boundaries_required: whether failure to load is fatal (bool)
+    disk_cache: passed to readLayer (bool/str)
+
+    Returns a GeoDataFrame, or None if loading failed and boundaries
+    were not required.
+    """
+
+    try:
+        # load shapefile, make no checks
+        return readLayer(directory+'/boundaries.shp.zip',disk_cache)
+    except:
+        if boundaries_required:
+            print(f'FATAL: boundaries could not be loaded for zone {directory} - aborting')
+            raise
+        else:
+            print(f'INFO: boundaries could not be loaded for zone {directory} - continuing')
+            return None
+
+
+# helper
+def listComposites(directory):
+    """List the composites available in a DEIMS site directory without
+    reading them.
+
+    A composite is either an unzipped shapefile or a boundaries.shp.zip
+    in its own subdirectory of 'composites'. Composites whose files are
+    evidently incomplete, which an eager load would skip, are reported
+    and left out.
+
+    directory: DEIMS site directory (str/path)
+    """
+
+    composites = []
+    for x in sorted(os.listdir(directory+'/composites')):
+        try:
+            contents = os.listdir(f'{directory}/composites/{x}')
+        except NotADirectoryError:
+            continue
+        if any([y.endswith('.shp') for y in contents]):
+            names = contents
+        elif 'boundaries.shp.zip' in contents:
+            path = f'{directory}/composites/{x}/boundaries.shp.zip'
+            names = []
+            if zipfile.is_zipfile(path):
+                with zipfile.ZipFile(path) as f:
+                    names = f.namelist()
+        else:
+            continue
+        if not all([any([y.endswith(z) for y in names]) for z in ('.shp','.shx','.dbf')]):
+            print(f'INFO: composite {x} of {directory} is incomplete - skipping')
+            continue
+        composites.append(x)
+
+    return composites
+
+
+# helper
+def compositeSource(directory,composite):
+    """Return the path to read a composite from: its directory if it
+    holds an unzipped shapefile, otherwise its boundaries.shp.zip.
+
+    directory: DEIMS site directory (str/path)
+    composite: zone code of the composite (str)
+    """
+
+    composite_dir = f'{directory}/composites/{composite}'
+    if any([x.endswith('.shp') for x in os.listdir(composite_dir)]):
+        return composite_dir
+    return f'{composite_dir}/boundaries.shp.zip'
+
+
+# helper
+def readComposite(directory,composite,disk_cache=True):
+    """Read a single composite from a DEIMS site directory.
+
+    directory: DEIMS site directory (str/path)
+    composite: zone code of the composite (str)
+    disk_cache: passed to readLayer (bool/str)
+    """
+
+    return readLayer(compositeSource(directory,composite),disk_cache)
+
+
+# simplification tolerance of each tier of geometry saved alongside
+# boundaries and composites, as a fraction of the longest side of the
+# layer's extent - 'coarse' is about a pixel of a 1000 pixel plot
+GEOMETRY_TIERS = {
+        'medium': 1e-4,
+        'coarse': 1e-3,
+        }
+
+
+# helper
+def tierSource(source,tier):
+    """Return the path of a simplified tier of a layer, which is saved
+    beside it as 'boundaries-<tier>.shp.zip'.
+
+    source: path to a .shp.zip file or a shapefile directory (str)
+    tier: one of GEOMETRY_TIERS (str)
+    """
+
+    parent = source if os.path.isdir(source) else os.path.dirname(source)
+    return os.path.join(parent,f'boundaries-{tier}.shp.zip')
+
+
+# helper
+def simplifyLayer(layer,tier):
+    """Simplify each geometry of a layer to a tier of GEOMETRY_TIERS,
+    keeping every row and attribute. Geometries stay valid, but edges
+    shared between neighbouring zones are simplified independently.
+
+    layer: layer to simplify (GeoDataFrame)
+    tier: one of GEOMETRY_TIERS (str)
+    """
+
+    simplified = layer.copy()
+    if layer.empty:
+        return simplified
+    minx,miny,maxx,maxy = layer.total_bounds
+    tolerance = GEOMETRY_TIERS[tier]*max(maxx-minx,maxy-miny)
+    simplified[layer.geometry.name] = layer.geometry.simplify(tolerance,preserve_topology=True)
+
+    return simplified
+
+
+# helper
+def saveGeometryTiers(layer,source):
+    """Save every tier of GEOMETRY_TIERS of a layer beside it.
+
+    layer: full resolution layer (GeoDataFrame)
+    source: path the full resolution layer is saved to (str)
+    """
+
+    for tier in GEOMETRY_TIERS:
+        simplifyLayer(layer,tier).to_file(tierSource(source,tier))
+
+
+# helper
+def readTier(source,tier,disk_cache=True):
+    """Read a simplified tier of a layer, or simplify the layer itself
+    if the tier was never saved or is older than the layer.
+
+    source: path to a .shp.zip file or a shapefile directory (str)
+    tier: one of GEOMETRY_TIERS (str)
+    disk_cache: passed to readLayer (bool/str)
+    """
+
+    path = tierSource(source,tier)
+    if os.path.isfile(path) and os.path.getmtime(path) >= max([os.path.getmtime(x) for x in layerSourceFiles(source)]):
+        return readLayer(path,disk_cache)
+
+    return simplifyLayer(readLayer(source,disk_cache),tier)
+
+
+# utility
+def geometryTier(entry,tier,composite=None):
+    """Return a simplified tier of the boundaries of a site or zone, or
+    of one of a site's composites, e.g. for plotting. Anything which
+    clips or exports geometry should use the full resolution layers.
+
+    entry: a site or zone as loaded by loadDirectory or loadAllInfo
+      (LazyDirectory/dict)
+    tier: one of GEOMETRY_TIERS (str)
+    composite: zone code of a composite of the site, None for the
+      boundaries (str)
+    """
+
+    if isinstance(entry,(LazyDirectory,StoreEntry)):
+        return entry.tier(tier,composite)
+
+    layer = entry['boundaries'] if composite is None else entry['composites'][composite]
+    return simplifyLayer(layer,tier)
+
+
+# helper
+def estimateFootprint(value):
+    """Roughly estimate the memory used by a loaded GeoDataFrame in
+    bytes, counting geometries by the size of their WKB.
+
+    value: GeoDataFrame or None
+    """
+
+    if value is None:
+        return 0
+    attributes = value.drop(columns=value.geometry.name).memory_usage(deep=True).sum()
+    geometries = value.geometry.apply(lambda g: 0 if g is None else len(g.wkb)).sum()
+
+    return int(attributes + geometries)
+
+
+class GeometryCache:
+    """Least-recently-used store of boundaries loaded on demand.
+
+    Shared by all lazy entries created by one call to loadAllInfo.
+    When either budget is exceeded the least recently used entries are
+    dropped; they are simply read again on their next access.
+
+    max_entries: most GeoDataFrames to hold, None for no limit or 0 to
+      hold nothing (int)
+    max_bytes: most memory to hold as estimated by estimateFootprint,
+      None for no limit, in which case sizes aren't estimated (int)
+    """
+
+    def __init__(self,max_entries=None,max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    def get(self,key,loader):
+        """Return the cached value for key, calling loader() to create
+        it if absent.
+
+        The loader runs outside the lock, so a slow read doesn't hold up
+        other lookups; two threads missing the same key may both load
+        it, and the first to finish is kept.
+        """
+
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                self._items.move_to_end(key)
+                return self._items[key][0]
+            self.misses += 1
+
+        value = loader()
+        if self.max_entries == 0:
+            return value
+        size = estimateFootprint(value) if self.max_bytes is not None else 0
+
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key][0]
+            self._items[key] = (value,size)
+            self._bytes += size
+            self._evict(key)
+            return value
+
+    def discard(self,key):
+        """Forget a single entry, e.g. after its files change."""
+
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Return counters describing the cache as a dict."""
+
+        with self._lock:
+            return {
+                    'entries': len(self._items),
+                    'bytes': self._bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    }
+
+    def _evict(self,keep):
+        # never evict the entry just loaded, even if it alone exceeds the budget
+        while len(self._items) > 1:
+            over_entries = self.max_entries is not None and len(self._items) > self.max_entries
+            over_bytes = self.max_bytes is not None and self._bytes > self.max_bytes
+            if not (over_entries or over_bytes):
+                break
+            oldest = next(iter(self._items))
+            if oldest == keep:
+                self._items.move_to_end(oldest)
+                continue
+            self._bytes -= self._items.pop(oldest)[1]
+
+
+class LazyComposites(Mapping):
+    """Read-only dict of a DEIMS site's composites, keyed by zone code,
+    which reads each composite on first access.
+
+    Available codes are listed when created so that membership tests
+    and iteration never touch the shapefiles themselves.
+    """
+
+    def __init__(self,directory,cache,disk_cache=True):
+        self.directory = directory
+        self._cache = cache
+        self._disk_cache = disk_cache
+        self._codes = listComposites(directory)
+        # codes of composites which could not be read, kept apart from
+        # _codes so that iterators over them are never disturbed
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def __getitem__(self,key):
+        if key not in self:
+            raise KeyError(key)
+        try:
+            return self._cache.get(
+                    (self.directory,'composites',key),
+                    lambda: readComposite(self.directory,key,self._disk_cache)
+                    )
+        except Exception as e:
+            # skip it from now on, as an eager load would have
+            with self._lock:
+                if key not in self._failed:
+                    print(f'INFO: composite {key} of {self.directory} could not be read ({e}) - skipping')
+                    self._failed.add(key)
+            raise KeyError(key)
+
+    def __iter__(self):
+        # a snapshot, so that composites failing mid-loop don't shift it
+        with self._lock:
+            return iter([x for x in self._codes if x not in self._failed])
+
+    def __len__(self):
+        with self._lock:
+            return len([x for x in self._codes if x not in self._failed])
+
+    def __contains__(self,key):
+        with self._lock:
+            return key in self._codes and key not in self._failed
+
+
+class LazyDirectory(Mapping):
+    """Read-only dict of a DEIMS site or administrative zone, with the
+    same keys as the output of loadDirectory, whose 'boundaries' (and
+    for sites 'composites') are read on first access.
+
+    Metadata is read and checked immediately.
+    """
+
+    def __init__(self,directory,dir_type,required_metadata,boundaries_required,cache,nat_zone_group=None,disk_cache=True):
+        self.directory = directory
+        self.dir_type = dir_type
+        self._boundaries_required = boundaries_required
+        self._cache = cache
+        self._disk_cache = disk_cache
+        self._items = {'metadata': readMetadata(directory,required_metadata)}
+        # fail at startup rather than on first access, as an eager load would
+        if boundaries_required and not os.path.isfile(directory+'/boundaries.shp.zip'):
+            print(f'FATAL: boundaries could not be found for zone {directory} - aborting')
+            raise FileNotFoundError(directory+'/boundaries.shp.zip')
+        if dir_type == 'deims':
+            self._items['composites'] = LazyComposites(directory,cache,disk_cache)
+        else:
+            self._items['nat_zone_group'] = nat_zone_group
+
+    def __getitem__(self,key):
+        if key == 'boundaries':
+            return self._cache.get(
+                    (self.directory,'boundaries'),
+                    lambda: readBoundaries(self.directory,self._boundaries_required,self._disk_cache)
+                    )
+        return self._items[key]
+
+    def tier(self,tier,composite=None):
+        """Read a simplified tier of the boundaries, or of a composite,
+        keeping it in the cache - see geometryTier."""
+
+        if composite is None:
+            source = self.directory+'/boundaries.shp.zip'
+            key = (self.directory,'boundaries',tier)
+        else:
+            if composite not in self._items['composites']:
+                raise KeyError(composite)
+            source = compositeSource(self.directory,composite)
+            key = (self.directory,'composites',composite,tier)
+
+        return self._cache.get(key,lambda: readTier(source,tier,self._disk_cache))
+
+    def __iter__(self):
+        return iter(['metadata','boundaries'] + [x for x in self._items if x != 'metadata'])
+
+    def __len__(self):
+        return len(self._items) + 1
+
+
+class PackedLayer:
+    """A layer held compactly: its geometries as one buffer of WKB, with
+    an array of offsets into it, and its text attributes as categoricals.
+
+    Geometry objects are only created by frame, e.g. to plot or export.
+
+    layer: layer to pack (GeoDataFrame)
+    """
+
+    def __init__(self,layer):
+        self.columns = list(layer.columns)
+        self.geometry_name = layer.geometry.name
+        self.crs = layer.crs
+        wkbs = [b'' if x is None else x.wkb for x in layer.geometry]
+        self.offsets = np.cumsum([0]+[len(x) for x in wkbs],dtype='int64')
+        self.buffer = b''.join(wkbs)
+
+        attributes = pd.DataFrame(layer.drop(columns=self.geometry_name))
+        self.dtypes = {x: attributes[x].dtype for x in attributes.columns}
+        for x in attributes.columns:
+            if attributes[x].dtype == object:
+                attributes[x] = attributes[x].astype('category')
+        self._attributes = attributes
+
+    def table(self):
+        """Return the attributes, without geometry, as they were
+        (DataFrame)."""
+
+        return self._attributes.astype(self.dtypes)
+
+    def frame(self):
+        """Return the layer as it was (GeoDataFrame)."""
+
+        geometries = [
+                shapely.wkb.loads(self.buffer[x:y]) if y > x else None
+                for x,y in zip(self.offsets[:-1],self.offsets[1:])
+                ]
+        frame = self.table()
+        frame[self.geometry_name] = geometries
+
+        return gpd.GeoDataFrame(frame[self.columns],geometry=self.geometry_name,crs=self.crs)
+
+    def nbytes(self):
+        """Memory held, in bytes (int)."""
+
+        return len(self.buffer) + self.offsets.nbytes + int(self._attributes.memory_usage(deep=True).sum())
+
+
+class PackedComposites(Mapping):
+    """Read-only dict of a DEIMS site's composites, keyed by zone code,
+    held as PackedLayers and unpacked into the cache on access."""
+
+    def __init__(self,directory,cache,disk_cache=True):
+        self.directory = directory
+        self._cache = cache
+        self._layers = {}
+        for x in listComposites(directory):
+            try:
+                self._layers[x] = PackedLayer(readComposite(directory,x,disk_cache))
+            except:
+                continue
+
+    def __getitem__(self,key):
+        return self._cache.get((self.directory,'composites',key),self._layers[key].frame)
+
+    def attributes(self,key):
+        """Return a composite's attributes without unpacking its
+        geometry (DataFrame)."""
+
+        return self._layers[key].table()
+
+    def __iter__(self):
+        return iter(self._layers)
+
+    def __len__(self):
+        return len(self._layers)
+
+    def __contains__(self,key):
+        return key in self._layers
+
+
+class PackedDirectory(LazyDirectory):
+    """A DEIMS site whose boundaries and composites are read immediately
+    and held as PackedLayers, for serving workflows from many worker
+    processes. Unpacked GeoDataFrames are kept in the cache; tiers are
+    read from disk as for LazyDirectory.
+
+    Arguments as for LazyDirectory, for a 'deims' directory.
+    """
+
+    def __init__(self,directory,dir_type,required_metadata,boundaries_required,cache,nat_zone_group=None,disk_cache=True):
+        super().__init__(directory,dir_type,required_metadata,boundaries_required,cache,nat_zone_group,disk_cache)
+        self._boundaries = PackedLayer(readBoundaries(directory,boundaries_required,disk_cache))
+        self._items['composites'] = PackedComposites(directory,cache,disk_cache)
+
+    def __getitem__(self,key):
+        if key == 'boundaries':
+            return self._cache.get((self.directory,'boundaries'),self._boundaries.frame)
+        return self._items[key]
+
+
+# utility
+def compositeAttributes(entry,composite):
+    """Return the attributes of a site's composite without its geometry,
+    unpacking no geometry if the site is a PackedDirectory.
+
+    entry: a site as loaded by loadDirectory or loadAllInfo
+    composite: zone code of the composite (str)
+    """
+
+    composites = entry['composites']
+    if isinstance(composites,PackedComposites):
+        return composites.attributes(composite)
+
+    layer = composites[composite]
+    return pd.DataFrame(layer.drop(columns=layer.geometry.name))
 
 
 # utility
-def loadDirectory(directory,dir_type,required_metadata,boundaries_required,nat_zone_group=None):
+def loadDirectory(directory,dir_type,required_metadata,boundaries_required,nat_zone_group=None,cache=None,disk_cache=True,store=None):
     """Load a directory as a DEIMS site or administrative zone.
 
     directory: directory to load (str/path)
@@ -69,6 +849,12 @@ def loadDirectory(directory,dir_type,required_metadata,boundaries_required,nat_z
       (list(str))
     boundaries_required: whether a shapfile of boundaries must exist
       (bool)
+    cache: if given, return a LazyDirectory which reads boundaries on
+      first access and keeps them in this cache (GeometryCache)
+    disk_cache: where to keep GeoParquet copies of shapefiles, see
+      readLayer (bool/str)
+    store: GeoPackage to load from instead, in which case directory is
+      the site's ID suffix or the zone's code - see saveToStore (str)
     """
 
     # PREP
@@ -78,46 +864,34 @@ def loadDirectory(directory,dir_type,required_metadata,boundaries_required,nat_z
     if dir_type == 'nat-zone' and nat_zone_group is None:
         print('nat_zone_group required for nat-zone')
         raise Exception
+
+    if store is not None:
+        entries = [x for x in storeEntries(store,dir_type) if x['code'] == directory]
+        if not entries:
+            raise KeyError(f'{dir_type} {directory} not in store {store}')
+        checkStoreEntry(store,entries[0],required_metadata,boundaries_required)
+        return loadStoreEntry(store,entries[0],cache)
+
     directory = os.path.normpath(directory)
-    shapefile_path = 'zip://'+directory+'/boundaries.shp.zip'
+
+    if cache is not None:
+        return LazyDirectory(directory,dir_type,required_metadata,boundaries_required,cache,nat_zone_group,disk_cache)
 
     # common to DEIMS and ZONES
     # METADATA
-    with open(directory+'/metadata.json') as f:
-        raw_metadata = f.read()
-    metadata = json.loads(raw_metadata)
-
-    # check for required keys
-    keys = list(metadata)
-    if not all([x in keys for x in required_metadata]):
-        print('Metadata missing required attributes')
-        raise Exception
+    metadata = readMetadata(directory,required_metadata)
 
     # SHAPEFILE
-    try:
-        # load shapefile, make no checks
-        boundaries = gpd.read_file(shapefile_path)
-    except:
-        if boundaries_required:
-            print(f'FATAL: boundaries could not be loaded for zone {directory} - aborting')
-            raise
-        else:
-            print(f'INFO: boundaries could not be loaded for zone {directory} - continuing')
-            boundaries = None
+    boundaries = readBoundaries(directory,boundaries_required,disk_cache)
 
     # DEIMS-specific
     if dir_type == 'deims':
-        potential_composites = os.listdir(directory+'/composites')
         composites = {}
-        for x in potential_composites:
+        for x in listComposites(directory):
             try:
-                composite = gpd.read_file(f'{directory}/composites/{x}')
+                composites[x] = readComposite(directory,x,disk_cache)
             except:
-                try:
-                    composite = gpd.read_file(f'zip://{directory}/composites/{x}/boundaries.shp.zip')
-                except:
-                    continue
-            composites[x] = composite
+                continue
 
         return {
                 'metadata': metadata,
@@ -141,47 +915,389 @@ def loadDirectory(directory,dir_type,required_metadata,boundaries_required,nat_z
                     }
 
 
-# useful wrapper
-def loadAllInfo(sf_root):
-    """Parse and load a directory according to application logic and
-    return two dicts, DEIMS sites and administrative zones.
+# helper
+def findZoneDirectories(sf_root):
+    """Find the directory of each administrative zone under sf_root.
 
     sf_root: directory in which to search - for expected structure see
       shapefiles/ (str)
+
+    Returns a dict keyed by zone code (see loadAllInfo) of dicts of
+    'directory', 'dir_type' and 'nat_zone_group'.
     """
 
-    validated_zones = {}
-    validated_deims_sites = {}
+    zone_dirs = {}
 
-    # we'll search these directories for data
-    nuts_zone_dirs = os.listdir(f'{sf_root}/zones/nuts')
-    lau_zone_dirs = os.listdir(f'{sf_root}/zones/lau')
-    national_zone_dirs = os.listdir(f'{sf_root}/zones/national')
-    deims_sites_to_try = os.listdir(f'{sf_root}/deims/')
     # nuts directories will contain these subdirectories
     nuts_level_dir_names = ['nuts0','nuts1','nuts2','nuts3']
-
-    # try to load each NUTS zone...
-    for x in nuts_zone_dirs:
+    for x in os.listdir(f'{sf_root}/zones/nuts'):
         for y in nuts_level_dir_names:
-            z = loadDirectory(f'{sf_root}/zones/nuts/{x}/{y}','eu-zone',['displayName','IDColumn','nameColumn'],True)
             title = x + '-' + y[-1]
-            validated_zones[title] = z
+            zone_dirs[title] = {'directory': f'{sf_root}/zones/nuts/{x}/{y}', 'dir_type': 'eu-zone', 'nat_zone_group': None}
 
-    # ...try to load each LAU zone...
-    for x in lau_zone_dirs:
-        z = loadDirectory(f'{sf_root}/zones/lau/{x}','eu-zone',['displayName','IDColumn','nameColumn'],True)
-        validated_zones[x] = z
+    for x in os.listdir(f'{sf_root}/zones/lau'):
+        zone_dirs[x] = {'directory': f'{sf_root}/zones/lau/{x}', 'dir_type': 'eu-zone', 'nat_zone_group': None}
 
-    # ...try to load each national zone...
-    for x in national_zone_dirs:
+    for x in os.listdir(f'{sf_root}/zones/national'):
         for y in os.listdir(f'{sf_root}/zones/national/{x}'):
-            z = loadDirectory(f'{sf_root}/zones/national/{x}/{y}','nat-zone',['displayName'],False,x)
-            validated_zones[y] = z
+            zone_dirs[y] = {'directory': f'{sf_root}/zones/national/{x}/{y}', 'dir_type': 'nat-zone', 'nat_zone_group': x}
+
+    return zone_dirs
+
+
+# metadata keys which must be present, and whether boundaries must be
+# present, for each type of directory
+REQUIRED_METADATA = {
+        'deims': ['id','displayName','nationalZonesAvailable'],
+        'eu-zone': ['displayName','IDColumn','nameColumn'],
+        'nat-zone': ['displayName'],
+        }
+BOUNDARIES_REQUIRED = {
+        'deims': True,
+        'eu-zone': True,
+        'nat-zone': False,
+        }
+
+
+# useful wrapper
+def loadAllInfo(sf_root,lazy=True,max_entries=32,max_bytes=None,disk_cache=True,store=None,serving=False):
+    """Parse and load a directory according to application logic and
+    return two dicts, DEIMS sites and administrative zones.
+
+    By default only metadata is read here: each site and zone is a
+    LazyDirectory whose boundaries and composites are read on first
+    access and then held in a shared GeometryCache, which evicts the
+    least recently used when over budget.
+
+    sf_root: directory in which to search - for expected structure see
+      shapefiles/ (str)
+    lazy: whether to defer reading boundaries, otherwise everything is
+      read immediately and held indefinitely (bool)
+    max_entries: most GeoDataFrames to keep loaded when lazy (int)
+    max_bytes: approximate memory budget for loaded GeoDataFrames when
+      lazy, None for no limit (int)
+    disk_cache: where to keep GeoParquet copies of shapefiles, see
+      readLayer (bool/str)
+    store: GeoPackage to load from instead of sf_root, see loadStore
+      (str)
+    serving: load a compact registry for serving workflows rather than
+      creating composites: sites are PackedDirectory entries, read
+      immediately, and zone boundaries are read each time they are
+      used rather than kept, as only composites use them (bool)
+    """
+
+    if store is not None:
+        if serving:
+            raise ValueError('serving is only available for shapefile directories')
+        return loadStore(store,lazy,max_entries,max_bytes)
+
+    cache = GeometryCache(max_entries,max_bytes) if lazy or serving else None
+    zone_cache = GeometryCache(0) if serving else cache
+    validated_zones = {}
+    validated_deims_sites = {}
+
+    # load each NUTS, LAU and national zone...
+    for x,y in findZoneDirectories(sf_root).items():
+        if y['dir_type'] == 'eu-zone':
+            z = loadDirectory(y['directory'],'eu-zone',REQUIRED_METADATA['eu-zone'],BOUNDARIES_REQUIRED['eu-zone'],cache=zone_cache,disk_cache=disk_cache)
+        else:
+            z = loadDirectory(y['directory'],'nat-zone',REQUIRED_METADATA['nat-zone'],BOUNDARIES_REQUIRED['nat-zone'],y['nat_zone_group'],cache=zone_cache,disk_cache=disk_cache)
+        validated_zones[x] = z
 
     # ...try to load each DEIMS site
-    for x in deims_sites_to_try:
-        z = loadDirectory(f'{sf_root}/deims/{x}','deims',['id','displayName','nationalZonesAvailable'],True)
+    for x in os.listdir(f'{sf_root}/deims/'):
+        if serving:
+            z = PackedDirectory(os.path.normpath(f'{sf_root}/deims/{x}'),'deims',REQUIRED_METADATA['deims'],BOUNDARIES_REQUIRED['deims'],cache,disk_cache=disk_cache)
+        else:
+            z = loadDirectory(f'{sf_root}/deims/{x}','deims',REQUIRED_METADATA['deims'],BOUNDARIES_REQUIRED['deims'],cache=cache,disk_cache=disk_cache)
         validated_deims_sites[x] = z
 
     return (validated_zones,validated_deims_sites)
+
+
+# index tables of a GeoPackage store, alongside its layers: every site
+# and zone, every layer and an R*Tree of the extent of each layer
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS store_entries (
+    code TEXT NOT NULL,
+    dir_type TEXT NOT NULL,
+    nat_zone_group TEXT,
+    metadata TEXT NOT NULL,
+    PRIMARY KEY (dir_type,code)
+);
+CREATE TABLE IF NOT EXISTS store_layers (
+    id INTEGER PRIMARY KEY,
+    code TEXT NOT NULL,
+    dir_type TEXT NOT NULL,
+    level TEXT NOT NULL,
+    layer TEXT NOT NULL UNIQUE,
+    UNIQUE (dir_type,code,level)
+);
+CREATE INDEX IF NOT EXISTS store_layers_level ON store_layers (level);
+CREATE VIRTUAL TABLE IF NOT EXISTS store_layers_rtree USING rtree(id,minx,maxx,miny,maxy);
+"""
+
+
+# helper
+def storeLayerName(code,level):
+    """Name of the GeoPackage layer holding the boundaries ('boundaries')
+    or a composite (its zone code) of a site or zone."""
+
+    return f'{code}__{level}'
+
+
+# helper
+def connectStore(store):
+    """Connect to a GeoPackage store, creating its index tables if
+    needed. The GeoPackage itself is created by writing its first layer.
+
+    store: path to the GeoPackage (str)
+    """
+
+    if not os.path.isfile(store):
+        raise FileNotFoundError(store)
+    connection = sqlite3.connect(store)
+    connection.executescript(STORE_SCHEMA)
+
+    return connection
+
+
+# utility
+def saveToStore(store,code,dir_type,metadata,layers,nat_zone_group=None):
+    """Save a site or zone to a GeoPackage store, replacing any previous
+    version of it.
+
+    Each layer is a GeoPackage layer, with the GeoPackage's own spatial
+    index of its features, and is listed in the store's index tables
+    along with its extent.
+
+    store: path to the GeoPackage, created if needed (str)
+    code: site ID suffix or zone code (str)
+    dir_type: as for loadDirectory (str)
+    metadata: contents of the site or zone's metadata.json (dict)
+    layers: GeoDataFrames keyed by level, 'boundaries' for the site or
+      zone's boundaries and zone codes for a site's composites (dict)
+    nat_zone_group: as for loadDirectory (str)
+    """
+
+    layers = {x: y for x,y in layers.items() if y is not None}
+    for level,layer in layers.items():
+        layer.to_file(store,layer=storeLayerName(code,level),driver='GPKG')
+
+    with closing(connectStore(store)) as connection:
+        with connection:
+            previous = connection.execute('SELECT level,layer FROM store_layers WHERE dir_type=? AND code=?',(dir_type,code)).fetchall()
+            connection.execute('DELETE FROM store_layers_rtree WHERE id IN (SELECT id FROM store_layers WHERE dir_type=? AND code=?)',(dir_type,code))
+            connection.execute('DELETE FROM store_layers WHERE dir_type=? AND code=?',(dir_type,code))
+            connection.execute('INSERT OR REPLACE INTO store_entries VALUES (?,?,?,?)',(code,dir_type,nat_zone_group,json.dumps(metadata)))
+            for level,layer in layers.items():
+                cursor = connection.execute('INSERT INTO store_layers (code,dir_type,level,layer) VALUES (?,?,?,?)',(code,dir_type,level,storeLayerName(code,level)))
+                if not layer.empty:
+                    extent = layer.to_crs('EPSG:4326') if layer.crs is not None else layer
+                    minx,miny,maxx,maxy = extent.total_bounds
+                    connection.execute('INSERT INTO store_layers_rtree VALUES (?,?,?,?,?)',(cursor.lastrowid,minx,maxx,miny,maxy))
+
+    # drop layers of composites which were removed
+    import fiona
+    for level,layer_name in previous:
+        if level not in layers:
+            try:
+                fiona.remove(store,layer=layer_name)
+            except Exception as e:
+                print(f'INFO: could not remove layer {layer_name} from {store} ({e}) - continuing')
+
+
+# helper
+def storeEntries(store,dir_type=None):
+    """List the sites and zones in a store, by code.
+
+    store: path to the GeoPackage (str)
+    dir_type: only list this type, as for loadDirectory (str)
+
+    Returns a list of dicts of 'code', 'dir_type', 'nat_zone_group',
+    'metadata' and 'levels' (see saveToStore).
+    """
+
+    query = 'SELECT code,dir_type,nat_zone_group,metadata FROM store_entries'
+    parameters = ()
+    if dir_type is not None:
+        query += ' WHERE dir_type=?'
+        parameters = (dir_type,)
+
+    with closing(connectStore(store)) as connection:
+        rows = connection.execute(query+' ORDER BY code',parameters).fetchall()
+        levels = {}
+        for code,entry_type,level in connection.execute('SELECT code,dir_type,level FROM store_layers ORDER BY level'):
+            levels.setdefault((entry_type,code),[]).append(level)
+
+    return [
+            {'code': x[0], 'dir_type': x[1], 'nat_zone_group': x[2], 'metadata': json.loads(x[3]), 'levels': levels.get((x[1],x[0]),[])}
+            for x in rows
+            ]
+
+
+# utility
+def readStoreLayer(store,code,level='boundaries',bbox=None):
+    """Read the boundaries or a composite of a site or zone from a store.
+
+    store: path to the GeoPackage (str)
+    code: site ID suffix or zone code (str)
+    level: 'boundaries' or the zone code of a composite (str)
+    bbox: only read features intersecting (minx, miny, maxx, maxy) in
+      the layer's CRS, found with the layer's spatial index (tuple)
+    """
+
+    return gpd.read_file(store,layer=storeLayerName(code,level),bbox=bbox)
+
+
+# utility
+def queryStore(store,bbox,dir_type=None,level=None):
+    """Find the layers of a store which overlap a bounding box, using the
+    R*Tree of layer extents.
+
+    store: path to the GeoPackage (str)
+    bbox: (minx, miny, maxx, maxy) in EPSG:4326 (tuple)
+    dir_type: only find layers of this type of entry (str)
+    level: only find these layers, e.g. 'boundaries' for sites and
+      zones themselves or a zone code for its composites (str)
+
+    Returns a list of (code, dir_type, level) tuples.
+    """
+
+    minx,miny,maxx,maxy = bbox
+    query = (
+            'SELECT l.code,l.dir_type,l.level FROM store_layers l JOIN store_layers_rtree r ON l.id = r.id'
+            ' WHERE r.maxx >= ? AND r.minx <= ? AND r.maxy >= ? AND r.miny <= ?'
+            )
+    parameters = [minx,maxx,miny,maxy]
+    if dir_type is not None:
+        query += ' AND l.dir_type = ?'
+        parameters.append(dir_type)
+    if level is not None:
+        query += ' AND l.level = ?'
+        parameters.append(level)
+
+    with closing(connectStore(store)) as connection:
+        return [tuple(x) for x in connection.execute(query+' ORDER BY l.code,l.level',parameters)]
+
+
+class StoreComposites(Mapping):
+    """Read-only dict of a site's composites in a store, keyed by zone
+    code, which reads each composite on first access."""
+
+    def __init__(self,store,code,levels,cache):
+        self.store = store
+        self.code = code
+        self._cache = cache
+        self._codes = [x for x in levels if x != 'boundaries']
+
+    def __getitem__(self,key):
+        if key not in self._codes:
+            raise KeyError(key)
+        return self._cache.get((self.store,self.code,key),lambda: readStoreLayer(self.store,self.code,key))
+
+    def __iter__(self):
+        return iter(self._codes)
+
+    def __len__(self):
+        return len(self._codes)
+
+    def __contains__(self,key):
+        return key in self._codes
+
+
+class StoreEntry(Mapping):
+    """Read-only dict of a site or zone in a store, with the same keys
+    as the output of loadDirectory, whose 'boundaries' (and for sites
+    'composites') are read on first access - the store's equivalent of
+    LazyDirectory."""
+
+    def __init__(self,store,entry,cache):
+        self.store = store
+        self.code = entry['code']
+        self.dir_type = entry['dir_type']
+        self._has_boundaries = 'boundaries' in entry['levels']
+        self._cache = cache
+        self._items = {'metadata': entry['metadata']}
+        if self.dir_type == 'deims':
+            self._items['composites'] = StoreComposites(store,self.code,entry['levels'],cache)
+        else:
+            self._items['nat_zone_group'] = entry['nat_zone_group']
+
+    def __getitem__(self,key):
+        if key == 'boundaries':
+            if not self._has_boundaries:
+                return None
+            return self._cache.get((self.store,self.code,'boundaries'),lambda: readStoreLayer(self.store,self.code))
+        return self._items[key]
+
+    def tier(self,tier,composite=None):
+        """Simplify the boundaries, or a composite, keeping the result
+        in the cache - see geometryTier."""
+
+        level = 'boundaries' if composite is None else composite
+        return self._cache.get(
+                (self.store,self.code,level,tier),
+                lambda: simplifyLayer(self['boundaries'] if composite is None else self['composites'][composite],tier)
+                )
+
+    def __iter__(self):
+        return iter(['metadata','boundaries'] + [x for x in self._items if x != 'metadata'])
+
+    def __len__(self):
+        return len(self._items) + 1
+
+
+# helper
+def checkStoreEntry(store,entry,required_metadata,boundaries_required):
+    """Check an entry of storeEntries as loadDirectory checks a
+    directory."""
+
+    checkMetadata(entry['metadata'],required_metadata)
+    if boundaries_required and 'boundaries' not in entry['levels']:
+        print(f'FATAL: boundaries could not be found for {entry["code"]} in {store} - aborting')
+        raise FileNotFoundError(storeLayerName(entry['code'],'boundaries'))
+
+
+# helper
+def loadStoreEntry(store,entry,cache=None):
+    """Load an entry of storeEntries, see loadDirectory."""
+
+    if cache is not None:
+        return StoreEntry(store,entry,cache)
+
+    code = entry['code']
+    loaded = {
+            'metadata': entry['metadata'],
+            'boundaries': readStoreLayer(store,code) if 'boundaries' in entry['levels'] else None,
+            }
+    if entry['dir_type'] == 'deims':
+        loaded['composites'] = {x: readStoreLayer(store,code,x) for x in entry['levels'] if x != 'boundaries'}
+    else:
+        loaded['nat_zone_group'] = entry['nat_zone_group']
+
+    return loaded
+
+
+# useful wrapper
+def loadStore(store,lazy=True,max_entries=32,max_bytes=None):
+    """Load every site and zone in a GeoPackage store, returning the
+    same two dicts as loadAllInfo.
+
+    store: path to the GeoPackage, see saveToStore (str)
+    lazy, max_entries, max_bytes: as for loadAllInfo
+    """
+
+    cache = GeometryCache(max_entries,max_bytes) if lazy else None
+    validated_zones = {}
+    validated_deims_sites = {}
+
+    for entry in storeEntries(store):
+        dir_type = entry['dir_type']
+        checkStoreEntry(store,entry,REQUIRED_METADATA[dir_type],BOUNDARIES_REQUIRED[dir_type])
+        if dir_type == 'deims':
+            validated_deims_sites[entry['code']] = loadStoreEntry(store,entry,cache)
+        else:
+            validated_zones[entry['code']] = loadStoreEntry(store,entry,cache)
+
+    return (validated_zones,validated_deims_sites)
@@ -0,0 +1,99 @@
+"""Pre-warm or verify the GeoParquet copies of every shapefile layer
+under a shapefiles directory - see directoryparse.readLayer.
+
+Usage, from this directory:
+    python geometry-cache.py warm [--sf-root ..] [--cache-root DIR]
+    python geometry-cache.py verify [--sf-root ..] [--cache-root DIR]
+    python geometry-cache.py tiers [--sf-root ..]
+
+warm reads every layer, building or rebuilding cached copies as needed.
+verify re-hashes every source and reports layers whose cached copy is
+missing or stale, exiting with status 1 if there are any.
+tiers saves the simplified tiers of every site boundary and composite
+which lacks them or has an older one - see directoryparse.geometryTier.
+"""
+
+
+import os
+import sys
+import argparse
+
+from directoryparse import GEOMETRY_TIERS, compositeSource, layerCacheStatus, layerSourceFiles, listComposites, readLayer, saveGeometryTiers, tierSource
+
+
+def findLayers(sf_root,zones=True):
+    """List every layer source under sf_root: each boundaries.shp.zip
+    of a zone or site, and each composite of each site.
+
+    sf_root: directory with the structure of shapefiles/ (str)
+    zones: whether to include zones, otherwise only sites (bool)
+    """
+
+    layers = []
+    for parent,dirs,files in os.walk(f'{sf_root}/zones'):
+        if zones and 'boundaries.shp.zip' in files:
+            layers.append(os.path.join(parent,'boundaries.shp.zip'))
+    for x in sorted(os.listdir(f'{sf_root}/deims')):
+        site_dir = f'{sf_root}/deims/{x}'
+        if os.path.isfile(f'{site_dir}/boundaries.shp.zip'):
+            layers.append(f'{site_dir}/boundaries.shp.zip')
+        if os.path.isdir(f'{site_dir}/composites'):
+            layers += [compositeSource(site_dir,y) for y in listComposites(site_dir)]
+
+    return [os.path.normpath(x) for x in sorted(layers)]
+
+
+def tiersOutdated(source):
+    """Whether any simplified tier of a layer is missing or older than
+    the layer itself.
+
+    source: path to a .shp.zip file or a shapefile directory (str)
+    """
+
+    newest = max([os.path.getmtime(x) for x in layerSourceFiles(source)])
+    for tier in GEOMETRY_TIERS:
+        path = tierSource(source,tier)
+        if not os.path.isfile(path) or os.path.getmtime(path) < newest:
+            return True
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage cached GeoParquet copies of shapefile layers.')
+    parser.add_argument('action',choices=['warm','verify','tiers'])
+    parser.add_argument('--sf-root',default='..',help='shapefiles directory (default: ..)')
+    parser.add_argument('--cache-root',default=None,help='keep cached copies here instead of next to each layer')
+    args = parser.parse_args()
+
+    disk_cache = args.cache_root if args.cache_root is not None else True
+
+    if args.action == 'tiers':
+        for x in findLayers(args.sf_root,zones=False):
+            if tiersOutdated(x):
+                saveGeometryTiers(readLayer(x,disk_cache),x)
+                print(f'saved    {x}')
+            else:
+                print(f'ok       {x}')
+        return 0
+
+    problems = 0
+    for x in findLayers(args.sf_root):
+        if args.action == 'warm':
+            before = layerCacheStatus(x,disk_cache)
+            readLayer(x,disk_cache)
+            after = layerCacheStatus(x,disk_cache)
+            if after != 'ok':
+                problems += 1
+            print(f'{after:8} {x}' + (f' (was {before})' if before != after else ''))
+        else:
+            status = layerCacheStatus(x,disk_cache,rehash=True)
+            if status != 'ok':
+                problems += 1
+            print(f'{status:8} {x}')
+
+    print(f'{problems} layer(s) not cached' if problems else 'all layers cached')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
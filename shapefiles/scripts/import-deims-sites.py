@@ -0,0 +1,57 @@
+"""Fetch many DEIMS sites from DEIMS-SDR, save them under shapefiles/deims
+and create their composites - see importDeimsSites in
+shapefile-generator.py.
+
+Usage, from this directory:
+    python import-deims-sites.py [--sf-root ..] [--cache-dir DIR]
+        [--threads N] [--processes N] ID [ID ...]
+
+IDs may be full (https://deims.org/...) or suffixes; '-' reads them from
+stdin, one per line. Set DEIMS_METADATA_URL and DEIMS_BOUNDARIES_URL to
+fetch from another server.
+"""
+
+
+import os
+import sys
+import argparse
+
+
+# load as app.R does with reticulate's source_python, so that free
+# variables in these files resolve against one shared namespace
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+for script in ['../../instrumentation.py','shapefile-generator.py','directoryparse.py']:
+    with open(os.path.join(SCRIPTS_DIR,script)) as f:
+        exec(compile(f.read(),script,'exec'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fetch DEIMS sites and create their composites.')
+    parser.add_argument('ids',nargs='+',help="DEIMS IDs, or '-' to read them from stdin")
+    parser.add_argument('--sf-root',default='..',help='shapefiles directory (default: ..)')
+    parser.add_argument('--cache-dir',default=None,help='cache responses here, to re-run cheaply')
+    parser.add_argument('--threads',type=int,default=8,help='concurrent fetches (default: 8)')
+    parser.add_argument('--processes',type=int,default=None,help='worker processes for composites (default: one per CPU)')
+    args = parser.parse_args()
+
+    ids = []
+    for x in args.ids:
+        ids += [y.strip() for y in sys.stdin if y.strip()] if x == '-' else [x]
+
+    validated_zones,validated_deims_sites = loadAllInfo(args.sf_root)
+    imported = importDeimsSites(
+            ids,
+            f'{args.sf_root}/deims',
+            validated_zones,
+            cache_dir=args.cache_dir,
+            threads=args.threads,
+            processes=args.processes
+            )
+
+    print(f'{len(imported["sites"])} of {len(ids)} site(s) imported')
+    failed = imported['errors'] or any([x['error'] for x in imported['results']])
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,43 @@
+"""Copy every site and zone under a shapefiles directory into a single
+GeoPackage store - see directoryparse.saveToStore.
+
+Usage, from this directory:
+    python import-store.py [--sf-root ..] [--store ../store.gpkg]
+
+Sites and zones already in the store are replaced, so the import can be
+re-run after the directories change.
+"""
+
+
+import sys
+import argparse
+
+from directoryparse import loadAllInfo, saveToStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import a shapefiles directory into a GeoPackage store.')
+    parser.add_argument('--sf-root',default='..',help='shapefiles directory (default: ..)')
+    parser.add_argument('--store',default='../store.gpkg',help='GeoPackage to write (default: ../store.gpkg)')
+    args = parser.parse_args()
+
+    validated_zones,validated_deims_sites = loadAllInfo(args.sf_root,max_entries=1,disk_cache=False)
+
+    # sites first - they always have boundaries, which creates the
+    # GeoPackage before any zone without boundaries is recorded
+    for code,site in validated_deims_sites.items():
+        layers = {x: site['composites'][x] for x in site['composites']}
+        layers['boundaries'] = site['boundaries']
+        saveToStore(args.store,code,'deims',site['metadata'],layers)
+        print(f'site {code}: {len(layers)-1} composite(s)')
+
+    for code,zone in validated_zones.items():
+        boundaries = zone['boundaries']
+        saveToStore(args.store,code,zone.dir_type,zone['metadata'],{'boundaries': boundaries},zone['nat_zone_group'])
+        print(f'zone {code}' + ('' if boundaries is not None else ' (no boundaries)'))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
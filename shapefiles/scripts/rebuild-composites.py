@@ -0,0 +1,51 @@
+"""Rebuild composites whose DEIMS site boundaries or zone layers have
+changed since they were built, and any which are missing - see
+rebuildComposites in shapefile-generator.py.
+
+Usage, from this directory:
+    python rebuild-composites.py [--sf-root ..] [--dry-run]
+        [--remove-orphans] [--no-adopt] [--processes N]
+
+The first run over an existing tree records its composites in
+shapefiles/composites-manifest.json without rebuilding them, unless
+--no-adopt is given.
+"""
+
+
+import os
+import argparse
+
+
+# load as app.R does with reticulate's source_python, so that free
+# variables in these files resolve against one shared namespace
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+for script in ['../../instrumentation.py','shapefile-generator.py','directoryparse.py']:
+    with open(os.path.join(SCRIPTS_DIR,script)) as f:
+        exec(compile(f.read(),script,'exec'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild stale or missing composites.')
+    parser.add_argument('--sf-root',default='..',help='shapefiles directory (default: ..)')
+    parser.add_argument('--dry-run',action='store_true',help='only report what would be done')
+    parser.add_argument('--remove-orphans',action='store_true',help='delete composites with no matching site or zone')
+    parser.add_argument('--no-adopt',action='store_true',help='rebuild composites missing from the manifest instead of recording them')
+    parser.add_argument('--processes',type=int,default=None,help='worker processes (default: one per CPU)')
+    args = parser.parse_args()
+
+    validated_zones,validated_deims_sites = loadAllInfo(args.sf_root)
+    plan = rebuildComposites(
+            args.sf_root,
+            validated_deims_sites,
+            validated_zones,
+            processes=args.processes,
+            dry_run=args.dry_run,
+            remove_orphans=args.remove_orphans,
+            adopt_untracked=not args.no_adopt
+            )
+
+    return 1 if any([x['error'] for x in plan.get('results',[])]) else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
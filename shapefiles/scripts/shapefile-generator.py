@@ -2,32 +2,87 @@
 
 Exports:
     - decomposeSite to generate a site/zone composite
+    - zoneAreas to tabulate zone areas for repeated use by decomposeSite
     - fetchDeimsSiteMetadata to fetch site metadata from deims.org
     - fetchDeimsSiteBoundaries to fetch site boundaries from deims.org
     - getNewDeimsSite to generate a complete DEIMS site (with
         composites) from deims.org
+    - importDeimsSites to fetch and save many DEIMS sites at once,
+        through a pooled and cached fetch layer (see fetchURL)
     - generateMissingComposites to check sites for missing composites
-        and generate new ones as needed
+        and generate new ones as needed, optionally in parallel
+    - planMissingComposites and runCompositeJobs, the two halves of
+        generateMissingComposites
+    - rebuildComposites to rebuild only composites whose site or zones
+        have changed, tracked in a manifest (see planCompositeRebuild)
+
+Composite generation is measured with span, from instrumentation.py
+if it was loaded first; otherwise span and spanned measure nothing.
 """
 
 
 import os
 import json
-import urllib.request
-
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import http.client
+import urllib.parse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
 import geopandas as gpd
 import pandas as pd
 import matplotlib.pyplot as plt
 
 
-def decomposeSite(deims_site, admin_zones, zone_id, zone_name, debug=False):
+# without instrumentation.py, measure nothing
+try:
+    span,spanned
+except NameError:
+    from contextlib import nullcontext
+
+    def span(name,**attributes):
+        return nullcontext()
+
+    def spanned(name):
+        return lambda function: function
+
+
+# helper
+def zoneAreas(admin_zones,zone_id):
+    """Tabulate the area of each zone in a layer, for decomposeSite.
+
+    admin_zones: admin zones/regions (gpd.GeoDataFrame)
+    zone_id: column name of the zone ID in admin_zones (str)
+
+    Returns zone areas, in units of the layer's CRS, indexed by zone ID
+    (pd.Series).
+    """
+
+    return pd.Series(admin_zones.geometry.area.values,index=admin_zones[zone_id].values)
+
+
+@spanned('decomposeSite')
+def decomposeSite(deims_site, admin_zones, zone_id, zone_name, debug=False, zone_areas=None):
     """Decompose a site by administrative zones.
 
+    Only zones whose bounding boxes intersect the site, found with the
+    layer's spatial index, are intersected with it, and their full areas
+    are looked up by ID rather than by merging geometries. If zone IDs
+    are not unique this falls back to comparing every zone's geometry.
+
     deims_site: site to decompose (gpd.GeoDataFrame)
     admin_zones: admin zones/regions to break deims_site into (gpd.GeoDataFrame)
     zone_id: column name of the zone ID in admin_zones (str)
     zone_name: column name of the zone name in admin_zones (str)
     debug: whether or not to plot the results for visual checking (bool)
+    zone_areas: output of zoneAreas for admin_zones, worth computing
+      once when decomposing many sites by the same zones - otherwise
+      only the areas of candidate zones are computed (pd.Series)
 
     Returns the resulting GDF.
     """
@@ -36,6 +91,47 @@ def decomposeSite(deims_site, admin_zones, zone_id, zone_name, debug=False):
     # this will be the CRS of the output GDF
     deims_site = deims_site.to_crs(admin_zones.crs)
 
+    if not admin_zones[zone_id].is_unique:
+        return decomposeSiteByMerge(deims_site, admin_zones, zone_id, zone_name, debug)
+
+    # only zones with intersecting bounding boxes can intersect the site
+    candidates = admin_zones.iloc[np.sort(admin_zones.sindex.query(deims_site.unary_union))]
+    if zone_areas is None:
+        zone_areas = zoneAreas(candidates,zone_id)
+
+    # check which zones intersect the LTSER site
+    if len(candidates) > 0:
+        ltser_zones = gpd.overlay(deims_site,candidates,how='intersection')
+    else:
+        ltser_zones = gpd.GeoDataFrame({zone_id: [], zone_name: []},geometry=gpd.GeoSeries([]),crs=admin_zones.crs)
+
+    # construct GDF of cropped zones + ratio of area intersection
+    gdf_out = gpd.GeoDataFrame(
+        {
+            'zone_id': ltser_zones[zone_id].astype('string'),
+            'zone_name': ltser_zones[zone_name].astype('string'),
+            'geometry': ltser_zones.geometry,
+            'area_ratio': ltser_zones.geometry.area/ltser_zones[zone_id].map(zone_areas)
+        },
+        crs = admin_zones.crs
+    )
+
+    # optional visual check of intersection shows full geometry of zones
+    if debug:
+        full_geometry = gpd.GeoSeries(ltser_zones[zone_id].map(candidates.set_index(zone_id).geometry),crs=admin_zones.crs)
+        plotDecomposition(deims_site,full_geometry)
+
+    return gdf_out
+
+
+# helper
+def decomposeSiteByMerge(deims_site, admin_zones, zone_id, zone_name, debug=False):
+    """Decompose a site by administrative zones, comparing against the
+    full geometry of every zone - see decomposeSite.
+
+    deims_site: site to decompose, in the CRS of admin_zones (gpd.GeoDataFrame)
+    """
+
     # check which zones intersect the LTSER site
     ltser_zones = gpd.overlay(deims_site,admin_zones,how='intersection')
 
@@ -62,39 +158,166 @@ def decomposeSite(deims_site, admin_zones, zone_id, zone_name, debug=False):
         crs = ltser_zones.crs
     )
 
-    # optional visual check of intersection adds full geometry of zones
+    # optional visual check of intersection shows full geometry of zones
     if debug:
-        # add and set full geometry
-        gdf_out['debug_geometry'] = ltser_zones['geometry_y']
-        gdf_out = gdf_out.set_geometry('debug_geometry')
-
-        # plot overlap - no need to return object since plots directly to (presumably) stdout
-        fig, ax = plt.subplots(figsize = (10,10))
-        ax.set_axis_off()
-        ax.set_title('Zones (blue) intersecting LTSER site (red)')
-        gdf_out.plot(ax=ax)
-        deims_site.boundary.plot(color='r',ax=ax)
-
-        # drop debug_geometry column so output is identical to non-debug
-        gdf_out.drop(columns='debug_geometry',inplace=True)
-        gdf_out = gdf_out.set_geometry('geometry')
-        return gdf_out
+        plotDecomposition(deims_site,gpd.GeoSeries(ltser_zones['geometry_y'],crs=ltser_zones.crs))
+
+    return gdf_out
+
+
+# helper
+def plotDecomposition(deims_site,full_geometry):
+    """Plot zones (blue) intersecting a site (red) for visual checking.
+
+    deims_site: decomposed site (gpd.GeoDataFrame)
+    full_geometry: full geometry of each intersecting zone (gpd.GeoSeries)
+    """
+
+    # plot overlap - no need to return object since plots directly to (presumably) stdout
+    fig, ax = plt.subplots(figsize = (10,10))
+    ax.set_axis_off()
+    ax.set_title('Zones (blue) intersecting LTSER site (red)')
+    full_geometry.plot(ax=ax)
+    deims_site.boundary.plot(color='r',ax=ax)
+
+
+# DEIMS-SDR endpoints, with {} for the site's ID suffix (metadata) or
+# full ID (boundaries) - set DEIMS_METADATA_URL and DEIMS_BOUNDARIES_URL
+# in the environment to use another server, e.g. a local stand-in
+DEIMS_METADATA_URL = os.environ.get('DEIMS_METADATA_URL','https://deims.org/api/sites/{}')
+DEIMS_BOUNDARIES_URL = os.environ.get('DEIMS_BOUNDARIES_URL','https://deims.org/geoserver/deims/ows?service=WFS&version=2.0.0&request=GetFeature&typeName=deims:deims_sites_boundaries&srsName=EPSG:4326&CQL_FILTER=deimsid=%27{}%27&outputFormat=SHAPE-ZIP')
+# attempts per request before giving up, and seconds to wait per socket
+# operation
+FETCH_ATTEMPTS = 3
+FETCH_TIMEOUT = 60
+# redirects followed per request, and the statuses which are followed
+FETCH_REDIRECTS = 5
+REDIRECT_STATUSES = (301,302,303,307,308)
+
+# open connections of each thread, keyed by (scheme, host)
+fetch_connections = threading.local()
+
+
+# helper
+def pooledConnection(scheme,netloc,fresh=False):
+    """Return this thread's kept-alive connection to a host, opening
+    one if needed or if fresh.
+
+    scheme: 'http' or 'https' (str)
+    netloc: host and optional port (str)
+    fresh: close any existing connection first (bool)
+    """
+
+    if not hasattr(fetch_connections,'pool'):
+        fetch_connections.pool = {}
+    key = (scheme,netloc)
+    if fresh and key in fetch_connections.pool:
+        fetch_connections.pool.pop(key).close()
+    if key not in fetch_connections.pool:
+        connection_type = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        fetch_connections.pool[key] = connection_type(netloc,timeout=FETCH_TIMEOUT)
+
+    return fetch_connections.pool[key]
+
+
+# helper
+def fetchURL(url,cache_dir=None):
+    """GET a URL over a pooled connection, retrying failed connections
+    and server errors with exponential backoff.
+
+    Redirects are followed, up to FETCH_REDIRECTS of them.
+
+    With cache_dir, responses are kept on disk along with their ETag
+    and Last-Modified headers, and the request is made conditional on
+    them, so that an unchanged response is not downloaded again. They
+    are cached under url, not the URL redirected to.
+
+    url: URL to fetch (str)
+    cache_dir: directory in which to cache responses (str)
+
+    Returns the body (bytes).
+    """
+
+    headers = {}
+    cached = None
+    if cache_dir is not None:
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        body_path = os.path.join(cache_dir,key+'.body')
+        sidecar_path = os.path.join(cache_dir,key+'.json')
+        try:
+            with open(sidecar_path) as f:
+                cached = json.load(f)
+        except (OSError,ValueError):
+            cached = None
+        if cached is not None and os.path.isfile(body_path):
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        else:
+            cached = None
+
+    location = url
+    for redirect in range(FETCH_REDIRECTS+1):
+        parts = urllib.parse.urlsplit(location)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+
+        for attempt in range(FETCH_ATTEMPTS):
+            if attempt:
+                time.sleep(0.5 * 2**attempt)
+            try:
+                connection = pooledConnection(parts.scheme,parts.netloc,fresh=attempt > 0)
+                connection.request('GET',target,headers=headers)
+                response = connection.getresponse()
+                # read the whole body so the connection can be reused
+                body = response.read()
+            except (http.client.HTTPException,OSError) as e:
+                error = f'{type(e).__name__}: {e}'
+                continue
+            if response.status == 304 and cached is not None:
+                with open(body_path,'rb') as f:
+                    return f.read()
+            if response.status == 429 or response.status >= 500:
+                error = f'HTTP {response.status}'
+                continue
+            if response.status in REDIRECT_STATUSES and response.getheader('Location'):
+                break
+            if response.status != 200:
+                raise OSError(f'HTTP {response.status} fetching {location}')
+            break
+        else:
+            raise OSError(f'{error} fetching {location}, after {FETCH_ATTEMPTS} attempts')
+
+        if response.status == 200:
+            break
+        # Location may be relative to the URL requested
+        location = urllib.parse.urljoin(location,response.getheader('Location'))
     else:
-        return gdf_out
+        raise OSError(f'more than {FETCH_REDIRECTS} redirects fetching {url}')
+
+    if cache_dir is not None and (response.getheader('ETag') or response.getheader('Last-Modified')):
+        os.makedirs(cache_dir,exist_ok=True)
+        for path,content in [(body_path,body),(sidecar_path,json.dumps({'url': url, 'etag': response.getheader('ETag'), 'last_modified': response.getheader('Last-Modified')}).encode('utf-8'))]:
+            fd,tmp_path = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd,'wb') as f:
+                f.write(content)
+            os.replace(tmp_path,path)
+
+    return body
 
 
 # helper
-def fetchDeimsSiteMetadata(deims_site_id_suffix):
+def fetchDeimsSiteMetadata(deims_site_id_suffix,cache_dir=None):
     """Fetch full site metadata from the DEIMS-SDR API.
 
     deims_site_id_suffix: ID to query (str)
+    cache_dir: see fetchURL (str)
     """
 
-    base_url = 'https://deims.org/api/sites/{}'
-
     # fetch and parse metadata
-    with urllib.request.urlopen(base_url.format(deims_site_id_suffix)) as f:
-        full_metadata = json.loads(f.read().decode('utf-8'))
+    full_metadata = json.loads(fetchURL(DEIMS_METADATA_URL.format(deims_site_id_suffix),cache_dir).decode('utf-8'))
 
     # take only what we need
     compact_metadata = {
@@ -108,25 +331,44 @@ def fetchDeimsSiteMetadata(deims_site_id_suffix):
 
 
 # helper
-def fetchDeimsSiteBoundaries(deims_site_id_suffix):
+def fetchDeimsSiteBoundaries(deims_site_id_suffix,cache_dir=None):
     """Fetch site boundaries from DEIMS-SDR GeoServer.
 
     deims_site_id_suffix: ID to query (str)
+    cache_dir: see fetchURL (str)
     """
 
     # even though IDs are given with a prefix it seems unlikely
     # this prefix will change
     deims_site_id_string = f'https://deims.org/{deims_site_id_suffix}'
-    base_url = 'https://deims.org/geoserver/deims/ows?service=WFS&version=2.0.0&request=GetFeature&typeName=deims:deims_sites_boundaries&srsName=EPSG:4326&CQL_FILTER=deimsid=%27{}%27&outputFormat=SHAPE-ZIP'
+    zipped = fetchURL(DEIMS_BOUNDARIES_URL.format(deims_site_id_string),cache_dir)
 
-    # great, you can just pass URLs directly to geopandas
-    boundaries = gpd.read_file(base_url.format(deims_site_id_string))
+    # the zipped shapefile has to be read from a file
+    fd,zip_path = tempfile.mkstemp(suffix='.zip')
+    try:
+        with os.fdopen(fd,'wb') as f:
+            f.write(zipped)
+        boundaries = gpd.read_file('zip://'+zip_path)
+    finally:
+        os.remove(zip_path)
 
     return boundaries
 
 
+# helper
+def deimsSuffix(deims_site_id,debug=False):
+    """Trim a full DEIMS ID (https://deims.org/...) to its suffix."""
+
+    if deims_site_id.startswith('https://deims.org/'):
+        deims_site_id = deims_site_id[18:]
+        if debug:
+            print('Possible full DEIMS ID detected - trimmed input to {}'.format(deims_site_id))
+
+    return deims_site_id
+
+
 # complete
-def getNewDeimsSite(deims_site_id_suffix,debug=False):
+def getNewDeimsSite(deims_site_id_suffix,debug=False,cache_dir=None):
     """Fetch a full DEIMS site from DEIMS-SDR and generate composites.
 
     Requires a dictionary to be available as a free variable,
@@ -136,23 +378,21 @@ def getNewDeimsSite(deims_site_id_suffix,debug=False):
 
     deims_site_id_suffix: ID to query (str)
     debug: whether to show extra information (bool)
+    cache_dir: see fetchURL (str)
 
     Returns the new site as a dict of 'metadata', 'boundaries' and
     'composites'.
     """
 
     # TODO: incorporate out-of-repo DEIMS module for validation and fetching functionality
-    if deims_site_id_suffix.startswith('https://deims.org/'):
-        deims_site_id_suffix = deims_site_id_suffix[18:]
-        if debug:
-            print('Possible full DEIMS ID detected - trimmed input to {}'.format(deims_site_id_suffix))
+    deims_site_id_suffix = deimsSuffix(deims_site_id_suffix,debug)
 
     # we probably have a valid DEIMS ID, proceed
     # fetch metadata
-    metadata = fetchDeimsSiteMetadata(deims_site_id_suffix)
+    metadata = fetchDeimsSiteMetadata(deims_site_id_suffix,cache_dir)
 
     # fetch boundaries
-    boundaries = fetchDeimsSiteBoundaries(deims_site_id_suffix)
+    boundaries = fetchDeimsSiteBoundaries(deims_site_id_suffix,cache_dir)
 
     # create composites
     composites = {}
@@ -175,7 +415,198 @@ def getNewDeimsSite(deims_site_id_suffix,debug=False):
             }
 
 
-def generateMissingComposites(deims_root,validated_deims_sites,validated_zones):
+# helper
+def expectedZones(site_metadata,validated_zones):
+    """Return the codes of the european and national zones a site
+    should have composites for, as a tuple of two lists.
+
+    site_metadata: metadata of a DEIMS site (dict)
+    validated_zones: available zones (dict)
+    """
+
+    european_zones = [x for x in list(validated_zones) if validated_zones[x]['nat_zone_group'] is None]
+    national_zones = []
+    if site_metadata['nationalZonesAvailable']:
+        national_zones = [x for x in list(validated_zones) if validated_zones[x]['nat_zone_group']==site_metadata['nationalZoneDir']]
+
+    return (european_zones,national_zones)
+
+
+# helper
+def planMissingComposites(deims_root,validated_deims_sites,validated_zones):
+    """List the composites missing from each site, without creating
+    any.
+
+    Arguments as for generateMissingComposites.
+
+    Returns a list of jobs, dicts of 'site', 'zone' and 'path' (the
+    composite directory to save to), grouped by zone.
+    """
+
+    jobs = []
+    for site in list(validated_deims_sites):
+        european_zones,national_zones = expectedZones(validated_deims_sites[site]['metadata'],validated_zones)
+        # check all european-wides are available
+        missing_euros = [x for x in european_zones if x not in validated_deims_sites[site]['composites']]
+        # if national zones, check they're all available
+        missing_nationals = [x for x in national_zones if x not in validated_deims_sites[site]['composites']]
+
+        if missing_euros:
+            print(f'site {site} is missing european zones {missing_euros}')
+        if missing_nationals:
+            print(f'site {site} is missing national zones {missing_nationals}')
+        for x in missing_euros + missing_nationals:
+            jobs.append({
+                'site': site,
+                'zone': x,
+                'path': f'{deims_root}/{validated_deims_sites[site]["metadata"]["id"]["suffix"]}/composites/{x}',
+                })
+
+    # each zone layer is then loaded once
+    zone_order = list(validated_zones)
+    return sorted(jobs,key=lambda x: zone_order.index(x['zone']))
+
+
+# helper
+def saveComposite(composite,composite_path):
+    """Save a composite as boundaries.shp.zip in a directory, along
+    with its simplified tiers (see directoryparse.GEOMETRY_TIERS),
+    writing each to a temporary file first so that it never appears
+    half-written. Any unzipped shapefile it replaces is deleted.
+
+    composite: composite to save (gpd.GeoDataFrame)
+    composite_path: directory to save to (str)
+    """
+
+    os.makedirs(composite_path,exist_ok=True)
+    source = f'{composite_path}/boundaries.shp.zip'
+    # keep the .shp.zip extension, which selects the zipped driver
+    tmp_path = f'{composite_path}/.boundaries-{os.getpid()}.shp.zip'
+    try:
+        composite.to_file(tmp_path)
+        os.replace(tmp_path,source)
+        # an unzipped copy, as some composites were stored, would
+        # otherwise still be read instead
+        removeUnzippedLayer(composite_path)
+        # tiers after the composite, so that they are newer than it and
+        # readTier uses them; until each is replaced, the old tier is
+        # older than the new composite and readTier simplifies instead
+        for tier in GEOMETRY_TIERS:
+            simplifyLayer(composite,tier).to_file(tmp_path)
+            os.replace(tmp_path,tierSource(source,tier))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# what buildComposite needs for the current zone layer - set by
+# runCompositeJobs before forking workers, which inherit it rather
+# than receiving a pickled copy of the layer with every job
+composite_job_context = {}
+
+
+# helper
+def buildComposite(job):
+    """Create and save one composite planned by planMissingComposites,
+    using the zone layer in composite_job_context.
+
+    Returns the job with its wall time in 'seconds' and any error
+    message in 'error'.
+    """
+
+    start = time.perf_counter()
+    try:
+        composite = decomposeSite(
+            composite_job_context['sites'][job['site']],
+            composite_job_context['boundaries'],
+            composite_job_context['IDColumn'],
+            composite_job_context['nameColumn'],
+            debug=False,
+            zone_areas=composite_job_context['zone_areas']
+            )
+        with span('composites/save',site=job['site'],zones=job['zone']):
+            saveComposite(composite,job['path'])
+        error = None
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+
+    return dict(job,seconds=time.perf_counter()-start,error=error)
+
+
+# helper
+def printProgress(done,total,result,elapsed):
+    """Default progress report for runCompositeJobs."""
+
+    status = 'FAILED '+result['error'] if result['error'] else 'ok'
+    print(f'[{done}/{total}] site {result["site"]} zone {result["zone"]}: {status} in {result["seconds"]:.1f}s ({done/elapsed:.2f} composites/s overall)')
+
+
+# helper
+def runCompositeJobs(jobs,validated_deims_sites,validated_zones,processes=1,progress=printProgress):
+    """Create and save composites planned by planMissingComposites.
+
+    Jobs are run one zone layer at a time. Each layer (and its zone
+    area table) is loaded once in this process and shared with forked
+    worker processes.
+
+    jobs: output of planMissingComposites (list(dict))
+    validated_deims_sites: deims sites to decompose (dict)
+    validated_zones: available zones to use (dict)
+    processes: number of worker processes, None for one per CPU or 1 to
+      work in this process (int)
+    progress: called as progress(done, total, result, elapsed seconds)
+      after each job, or None (function)
+
+    Returns a list of results, see buildComposite.
+    """
+
+    results = []
+    start = time.perf_counter()
+    zones = []
+    for x in jobs:
+        if x['zone'] not in zones:
+            zones.append(x['zone'])
+
+    try:
+        for zone in zones:
+            zone_jobs = [x for x in jobs if x['zone'] == zone]
+            if validated_zones[zone]['boundaries'] is None:
+                for x in zone_jobs:
+                    results.append(dict(x,seconds=0.0,error='zone boundaries unavailable'))
+                    if progress is not None:
+                        progress(len(results),len(jobs),results[-1],time.perf_counter()-start)
+                continue
+            composite_job_context.clear()
+            with span('composites/load-zones',zones=zone):
+                composite_job_context.update({
+                    'boundaries': validated_zones[zone]['boundaries'],
+                    'IDColumn': validated_zones[zone]['metadata']['IDColumn'],
+                    'nameColumn': validated_zones[zone]['metadata']['nameColumn'],
+                    'zone_areas': zoneAreas(validated_zones[zone]['boundaries'],validated_zones[zone]['metadata']['IDColumn']),
+                    'sites': {x['site']: validated_deims_sites[x['site']]['boundaries'] for x in zone_jobs},
+                    })
+
+            if processes == 1:
+                zone_results = map(buildComposite,zone_jobs)
+                pool = None
+            else:
+                pool = ProcessPoolExecutor(processes,mp_context=multiprocessing.get_context('fork'))
+                zone_results = (x.result() for x in as_completed([pool.submit(buildComposite,x) for x in zone_jobs]))
+            try:
+                for result in zone_results:
+                    results.append(result)
+                    if progress is not None:
+                        progress(len(results),len(jobs),result,time.perf_counter()-start)
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+    finally:
+        composite_job_context.clear()
+
+    return results
+
+
+def generateMissingComposites(deims_root,validated_deims_sites,validated_zones,processes=1,dry_run=False,progress=printProgress):
     """Use dicts to check sites for missing composites and create.
 
     Accepts two dictionaries, intended to be the output of loadAllInfo,
@@ -185,49 +616,287 @@ def generateMissingComposites(deims_root,validated_deims_sites,validated_zones):
       directories when saving (str)
     validated_deims_sites: deims sites to check (dict)
     validated_zones: available zones to use (dict)
+    processes: number of worker processes, None for one per CPU or 1 to
+      work in this process (int)
+    dry_run: only plan, returning the jobs from planMissingComposites
+      without creating anything (bool)
+    progress: see runCompositeJobs (function)
+
+    Returns the planned jobs if dry_run, otherwise their results - see
+    runCompositeJobs.
     """
 
-    # TODO: possibly add some validate mode where no action is taken
-    #
-    european_zones = [x for x in list(validated_zones) if validated_zones[x]['nat_zone_group'] is None]
+    jobs = planMissingComposites(deims_root,validated_deims_sites,validated_zones)
+    if dry_run:
+        return jobs
+
+    # could later return updated dict(s) instead
+    results = runCompositeJobs(jobs,validated_deims_sites,validated_zones,processes,progress)
+    failures = [x for x in results if x['error']]
+    if failures:
+        print(f'{len(failures)} of {len(results)} composites failed')
+
+    print('done')
+    return results
+
+
+# helper
+def fetchDeimsSite(deims_site_id,cache_dir=None):
+    """Fetch the metadata and boundaries of a DEIMS site, without
+    composites.
+
+    deims_site_id: full ID or ID suffix (str)
+    cache_dir: see fetchURL (str)
+
+    Returns the site as a dict of 'metadata', 'boundaries' and an empty
+    'composites'.
+    """
+
+    deims_site_id_suffix = deimsSuffix(deims_site_id)
+
+    return {
+            'metadata': fetchDeimsSiteMetadata(deims_site_id_suffix,cache_dir),
+            'boundaries': fetchDeimsSiteBoundaries(deims_site_id_suffix,cache_dir),
+            'composites': {},
+            }
+
+
+def importDeimsSites(deims_site_ids,deims_root,validated_zones,cache_dir=None,threads=8,processes=None,progress=printProgress):
+    """Fetch many DEIMS sites from DEIMS-SDR, save them in a directory of
+    sites and create their composites.
 
+    Sites are fetched by a pool of threads, each keeping its connections
+    open between requests (see fetchURL), and saved as they arrive.
+    Their composites are then created as runCompositeJobs does, one zone
+    layer at a time in worker processes.
+
+    deims_site_ids: full IDs or ID suffixes (list(str))
+    deims_root: directory of deims sites to save to (str)
+    validated_zones: available zones to use (dict)
+    cache_dir: directory in which to cache responses, so that an
+      interrupted import can be re-run cheaply (str)
+    threads: number of concurrent fetches (int)
+    processes: see runCompositeJobs (int)
+    progress: see runCompositeJobs (function)
+
+    Returns a dict of 'sites' (the saved sites by ID suffix, without
+    composites - load them again with loadDirectory), 'errors' (messages
+    by ID for sites which could not be fetched or saved) and 'results'
+    (see runCompositeJobs).
+    """
+
+    deims_site_ids = list(dict.fromkeys([deimsSuffix(x) for x in deims_site_ids]))
+    sites = {}
+    errors = {}
+
+    with span('import/fetch',sites=len(deims_site_ids)):
+        with ThreadPoolExecutor(threads) as pool:
+            futures = {pool.submit(fetchDeimsSite,x,cache_dir): x for x in deims_site_ids}
+            for future in as_completed(futures):
+                site_id = futures[future]
+                try:
+                    site = future.result()
+                    saveDeimsSite(site,deims_root)
+                except Exception as e:
+                    errors[site_id] = f'{type(e).__name__}: {e}'
+                    print(f'site {site_id}: FAILED {errors[site_id]}')
+                    continue
+                sites[site_id] = site
+                print(f'site {site_id}: fetched {site["metadata"]["displayName"]}')
+
+    jobs = planMissingComposites(deims_root,sites,validated_zones)
+    results = runCompositeJobs(jobs,sites,validated_zones,processes,progress)
+    failures = [x for x in results if x['error']]
+    if failures:
+        print(f'{len(failures)} of {len(results)} composites failed')
+
+    return {
+            'sites': sites,
+            'errors': errors,
+            'results': results,
+            }
+
+
+# name of the manifest of composites, kept in the shapefiles directory
+COMPOSITE_MANIFEST = 'composites-manifest.json'
+
+
+# helper
+def loadCompositeManifest(sf_root):
+    """Load the manifest recording what each composite was built from,
+    keyed by '<site>/<zone>', or an empty one if there is none yet.
+
+    sf_root: shapefiles directory (str)
+    """
+
+    try:
+        with open(f'{sf_root}/{COMPOSITE_MANIFEST}') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# helper
+def saveCompositeManifest(sf_root,manifest):
+    """Atomically save the manifest of composites.
+
+    sf_root: shapefiles directory (str)
+    manifest: see loadCompositeManifest (dict)
+    """
+
+    tmp_path = f'{sf_root}/.{COMPOSITE_MANIFEST}.{os.getpid()}'
+    with open(tmp_path,'w') as f:
+        f.write(json.dumps(manifest,indent=4,sort_keys=True))
+    os.replace(tmp_path,f'{sf_root}/{COMPOSITE_MANIFEST}')
+
+
+def planCompositeRebuild(sf_root,validated_deims_sites,validated_zones,manifest=None):
+    """Compare each site's composites against the manifest and the
+    current hashes of the site boundaries and zone layers.
+
+    Files are only re-hashed when their size or mtime differs from the
+    manifest. Only the filesystem is inspected, not the composites held
+    in validated_deims_sites.
+
+    sf_root: shapefiles directory (str)
+    validated_deims_sites: deims sites to check, as from loadAllInfo (dict)
+    validated_zones: available zones, as from loadAllInfo (dict)
+    manifest: manifest to compare against, loaded if not given (dict)
+
+    Returns a dict of 'current', 'stale', 'missing' and 'untracked' (not
+    in the manifest) jobs as for planMissingComposites, each with its
+    site and zone fingerprints added, plus 'orphaned', a list of
+    '<site>/<zone>' keys of composites on disk or in the manifest which
+    no longer correspond to an available site and zone.
+
+    Requires findZoneDirectories, fingerprintLayer and listComposites
+    from directoryparse to be available as free variables.
+    """
+
+    if manifest is None:
+        manifest = loadCompositeManifest(sf_root)
+    deims_root = f'{sf_root}/deims'
+    zone_dirs = findZoneDirectories(sf_root)
+
+    # fingerprint each zone layer once, reusing hashes recorded in the manifest
+    known_zones = {x['zone']: x['zone_fingerprint'] for x in manifest.values()}
+    zone_fingerprints = {}
+    for x in validated_zones:
+        source = f'{zone_dirs[x]["directory"]}/boundaries.shp.zip'
+        if os.path.isfile(source):
+            zone_fingerprints[x] = fingerprintLayer(source,known_zones.get(x))
+
+    plan = {'current': [], 'stale': [], 'missing': [], 'untracked': [], 'orphaned': []}
+    expected = set()
     for site in list(validated_deims_sites):
-        # check all european-wides are available
-        missing_euros = [x for x in european_zones if x not in validated_deims_sites[site]['composites']]
-        # if national zones, check they're all available
-        missing_nationals = []
-        if validated_deims_sites[site]['metadata']['nationalZonesAvailable']:
-            national_zones = [x for x in list(validated_zones) if validated_zones[x]['nat_zone_group']==validated_deims_sites[site]['metadata']['nationalZoneDir']]
-            missing_nationals = [x for x in national_zones if x not in validated_deims_sites[site]['composites']]
+        site_dir = f'{deims_root}/{site}'
+        known_site = next((x['site_fingerprint'] for x in manifest.values() if x['site'] == site),None)
+        site_fingerprint = fingerprintLayer(f'{site_dir}/boundaries.shp.zip',known_site)
+        on_disk = listComposites(site_dir)
+        european_zones,national_zones = expectedZones(validated_deims_sites[site]['metadata'],validated_zones)
+
+        for zone in european_zones + national_zones:
+            # composites can't be built from zones without boundaries
+            if zone not in zone_fingerprints:
+                if zone in on_disk:
+                    expected.add(f'{site}/{zone}')
+                continue
+            key = f'{site}/{zone}'
+            expected.add(key)
+            job = {
+                'site': site,
+                'zone': zone,
+                'path': f'{site_dir}/composites/{zone}',
+                'site_fingerprint': site_fingerprint,
+                'zone_fingerprint': zone_fingerprints[zone],
+                }
+            if zone not in on_disk:
+                plan['missing'].append(job)
+            elif key not in manifest:
+                plan['untracked'].append(job)
+            elif manifest[key]['site_fingerprint']['sha256'] != site_fingerprint['sha256'] or manifest[key]['zone_fingerprint']['sha256'] != zone_fingerprints[zone]['sha256']:
+                plan['stale'].append(job)
+            else:
+                plan['current'].append(job)
+
+    # anything else on disk or in the manifest is an orphan
+    on_disk = set()
+    for site in os.listdir(deims_root):
+        if os.path.isdir(f'{deims_root}/{site}/composites'):
+            on_disk.update([f'{site}/{x}' for x in os.listdir(f'{deims_root}/{site}/composites')])
+    plan['orphaned'] = sorted((on_disk | set(manifest)) - expected)
+
+    return plan
 
-        # create and save missing composites
-        # could later return updated dict(s) instead
-        if missing_euros:
-            print(f'site {site} is missing european zones {missing_euros}')
-            for x in missing_euros:
-                composite = decomposeSite(
-                    validated_deims_sites[site]['boundaries'],
-                    validated_zones[x]['boundaries'],
-                    validated_zones[x]['metadata']['IDColumn'],
-                    validated_zones[x]['metadata']['nameColumn'],
-                    debug=False
-                    )
-                composite_path = f'{deims_root}/{validated_deims_sites[site]["metadata"]["id"]["suffix"]}/composites/{x}'
-                os.makedirs(composite_path,exist_ok=True)
-                composite.to_file(f'{composite_path}/boundaries.shp.zip')
 
-        if missing_nationals:
-            print(f'site {site} is missing national zones {missing_nationals}')
-            for x in missing_nationals:
-                composite = decomposeSite(
-                    validated_deims_sites[site]['boundaries'],
-                    validated_zones[x]['boundaries'],
-                    validated_zones[x]['metadata']['IDColumn'],
-                    validated_zones[x]['metadata']['nameColumn'],
-                    debug=False
-                    )
-                composite_path = f'{deims_root}/{validated_deims_sites[site]["metadata"]["id"]["suffix"]}/composites/{x}'
-                os.makedirs(composite_path,exist_ok=True)
-                composite.to_file(f'{composite_path}/boundaries.shp.zip')
+# helper
+def manifestEntry(job):
+    """Record a composite job in the form kept in the manifest."""
 
+    return {
+            'site': job['site'],
+            'zone': job['zone'],
+            'site_fingerprint': job['site_fingerprint'],
+            'zone_fingerprint': job['zone_fingerprint'],
+            'built': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            }
+
+
+def rebuildComposites(sf_root,validated_deims_sites,validated_zones,processes=1,dry_run=False,remove_orphans=False,adopt_untracked=True,progress=printProgress):
+    """Rebuild only the composites which are missing or were built from
+    site boundaries or zone layers that have since changed, keeping
+    the manifest up to date - see planCompositeRebuild.
+
+    sf_root: shapefiles directory (str)
+    validated_deims_sites: deims sites to check, as from loadAllInfo (dict)
+    validated_zones: available zones, as from loadAllInfo (dict)
+    processes: see runCompositeJobs (int)
+    dry_run: only plan, changing nothing (bool)
+    remove_orphans: delete orphaned composites, otherwise they are only
+      reported (bool)
+    adopt_untracked: record composites missing from the manifest as
+      built from the current data, otherwise rebuild them - adopting is
+      how an existing tree gets its first manifest (bool)
+    progress: see runCompositeJobs (function)
+
+    Returns the plan, plus the results of any jobs run in 'results'.
+    """
+
+    manifest = loadCompositeManifest(sf_root)
+    plan = planCompositeRebuild(sf_root,validated_deims_sites,validated_zones,manifest)
+    for x in ['stale','missing','untracked','orphaned']:
+        if plan[x]:
+            print(f'{len(plan[x])} {x}: {plan[x] if x == "orphaned" else [y["site"]+"/"+y["zone"] for y in plan[x]]}')
+    print(f'{len(plan["current"])} current')
+    if dry_run:
+        return plan
+
+    # refresh sizes and mtimes of current composites so they aren't re-hashed next time
+    for x in plan['current']:
+        manifest[f'{x["site"]}/{x["zone"]}'].update(site_fingerprint=x['site_fingerprint'],zone_fingerprint=x['zone_fingerprint'])
+    if adopt_untracked:
+        for x in plan['untracked']:
+            manifest[f'{x["site"]}/{x["zone"]}'] = manifestEntry(x)
+    for x in plan['orphaned']:
+        if remove_orphans:
+            site,zone = x.split('/')
+            shutil.rmtree(f'{sf_root}/deims/{site}/composites/{zone}',ignore_errors=True)
+            manifest.pop(x,None)
+    saveCompositeManifest(sf_root,manifest)
+
+    # rebuild, recording each composite as soon as it is saved
+    jobs = plan['stale'] + plan['missing'] + ([] if adopt_untracked else plan['untracked'])
+    zone_order = list(validated_zones)
+    jobs = sorted(jobs,key=lambda x: zone_order.index(x['zone']))
+
+    def record(done,total,result,elapsed):
+        if not result['error']:
+            manifest[f'{result["site"]}/{result["zone"]}'] = manifestEntry(result)
+            saveCompositeManifest(sf_root,manifest)
+        if progress is not None:
+            progress(done,total,result,elapsed)
+
+    plan['results'] = runCompositeJobs(jobs,validated_deims_sites,validated_zones,processes,record)
     print('done')
+
+    return plan
@@ -0,0 +1,30 @@
+"""Fixtures shared by the tests, which load the scripts as app.R does."""
+
+
+import os
+
+import pytest
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS = [
+        'instrumentation.py',
+        'analyse.py',
+        'shapefiles/scripts/shapefile-generator.py',
+        'shapefiles/scripts/directoryparse.py',
+        ]
+
+
+@pytest.fixture
+def scripts():
+    """Namespace the scripts are executed in, as with reticulate's
+    source_python, so that free variables resolve against it."""
+
+    pytest.importorskip('geopandas')
+    pytest.importorskip('rasterio')
+    namespace = {'__name__': 'scripts'}
+    for script in SCRIPTS:
+        with open(os.path.join(REPO_ROOT,script)) as f:
+            exec(compile(f.read(),script,'exec'),namespace)
+
+    return namespace
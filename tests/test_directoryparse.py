@@ -0,0 +1,38 @@
+"""Tests of loading sites lazily, see directoryparse.py."""
+
+
+import os
+
+
+# helper
+def makeComposite(site_dir,code):
+    """Create an unzipped composite whose files are complete but empty."""
+
+    os.makedirs(f'{site_dir}/composites/{code}')
+    for extension in ('.shp','.shx','.dbf'):
+        open(f'{site_dir}/composites/{code}/boundaries{extension}','w').close()
+
+
+def test_unreadable_composite_is_skipped_mid_loop(scripts,tmp_path):
+    site_dir = str(tmp_path)
+    for code in ['a','b','c']:
+        makeComposite(site_dir,code)
+
+    def readComposite(directory,composite,disk_cache=True):
+        if composite == 'b':
+            raise ValueError('corrupt')
+        return composite
+    scripts['readComposite'] = readComposite
+
+    composites = scripts['LazyComposites'](site_dir,scripts['GeometryCache'](32))
+    read = []
+    for code in composites:
+        try:
+            read.append(composites[code])
+        except KeyError:
+            pass
+
+    assert read == ['a','c']
+    assert list(composites) == ['a','c']
+    assert len(composites) == 2
+    assert 'b' not in composites
@@ -0,0 +1,24 @@
+"""Tests of saving composites, see shapefile-generator.py."""
+
+
+import os
+
+
+def test_rebuilding_unzipped_composite_replaces_it(scripts,tmp_path):
+    gpd = scripts['gpd']
+    from shapely.geometry import box
+
+    site_dir = str(tmp_path)
+    composite_dir = f'{site_dir}/composites/councils'
+    old = gpd.GeoDataFrame({'zone_id': ['old']},geometry=[box(0,0,1,1)],crs='EPSG:4326')
+    new = gpd.GeoDataFrame({'zone_id': ['new']},geometry=[box(2,2,3,3)],crs='EPSG:4326')
+
+    # stored unzipped, as some composites in the checkout are
+    os.makedirs(composite_dir)
+    old.to_file(f'{composite_dir}/boundaries.shp')
+    assert list(scripts['readComposite'](site_dir,'councils')['zone_id']) == ['old']
+
+    scripts['saveComposite'](new,composite_dir)
+
+    assert scripts['compositeSource'](site_dir,'councils').endswith('boundaries.shp.zip')
+    assert list(scripts['readComposite'](site_dir,'councils')['zone_id']) == ['new']